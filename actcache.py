@@ -0,0 +1,279 @@
+# cache of the activations of single images
+# runs on overlapping image lists with the same weights compute the same
+# activations again and again. ActivationCache keeps the activations of
+# every image, reduced (e.g. the max over space) or full maps, as they come
+# out of the hooks, so the next run only forwards the images it has not
+# seen yet.
+#
+# An entry is keyed by the image, either by path, modification time and
+# size or by the SHA-1 of the file content, and lives in the store of its
+# (model weights digest, layer, spatial reduction, transform). Every store
+# is one memory-mapped float32 file of fixed size entries, the index of all
+# of them is index.json. The files of all the stores together stay within
+# max_bytes during a run: once they are at the limit, a new entry takes the
+# slot of the least recently used entry of its store instead of growing the
+# file. When the cache is saved the least recently used entries of all the
+# stores beyond max_bytes are dropped and every file is truncated to its
+# entries.
+
+import os
+import json
+import hashlib
+import heapq
+import threading
+import numpy as np
+
+from thumbcache import image_key
+
+
+def content_key(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def contiguous_runs(indices):
+    """[(i, j)] such that the sorted indices[i:j] are consecutive numbers."""
+    runs = []
+    start = 0
+    for i in range(1, len(indices) + 1):
+        if i == len(indices) or indices[i] != indices[i - 1] + 1:
+            runs.append((start, i))
+            start = i
+    return runs
+
+
+def model_digest(model):
+    """SHA-1 of the names and values of the parameters and buffers of model."""
+    import torch
+    digest = hashlib.sha1()
+    for name, value in model.state_dict().items():
+        value = value.detach().cpu().contiguous()
+        digest.update(('%s %s %s' % (name, value.dtype, tuple(value.shape))).encode('utf-8'))
+        digest.update(value.reshape(-1).view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+class _Store(object):
+    # the entries of one (model, layer, reduction, transform), all with the same shape
+
+    def __init__(self, root, name, meta):
+        self.filename = os.path.join(root, name + '.bin')
+        self.meta = meta
+        self.shape = tuple(meta['shape']) if meta.get('shape') else None
+        self.entries = meta.pop('entries', {})   # key -> [slot, last use]
+        self.num_slots = meta.pop('num_slots', 0)
+        used_slots = set(slot for slot, used in self.entries.values())
+        self.free = [slot for slot in range(self.num_slots - 1, -1, -1) if slot not in used_slots]
+        self.lru = [(used, key) for key, (slot, used) in self.entries.items()]   # heap of (last use, key)
+        heapq.heapify(self.lru)
+        self.data = None
+
+    def entry_bytes(self):
+        return int(np.prod(self.shape)) * 4 if self.shape else 0
+
+    def file_bytes(self):
+        return self.num_slots * self.entry_bytes()
+
+    def _map(self):
+        if self.data is None and self.num_slots > 0:
+            self.data = np.memmap(self.filename, dtype=np.float32, mode='r+', shape=(self.num_slots,) + self.shape)
+
+    def _grow(self, num_slots):
+        if self.data is not None:
+            self.data.flush()
+            self.data = None
+        with open(self.filename, 'ab') as f:
+            f.truncate(num_slots * self.entry_bytes())
+        self.free = list(range(num_slots - 1, self.num_slots - 1, -1)) + self.free
+        self.num_slots = num_slots
+        self._map()
+
+    def _evict(self):
+        # free the slot of the least recently used entry, False if there is none
+        while self.lru:
+            used, key = heapq.heappop(self.lru)
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != used:
+                # an older use of an entry used again since
+                continue
+            self.free.append(self.entries.pop(key)[0])
+            return True
+        return False
+
+    def _touch(self, key, slot, clock):
+        self.entries[key] = [slot, clock]
+        heapq.heappush(self.lru, (clock, key))
+
+    def get(self, keys, clock):
+        # ([n, ...] with the cached entries, bool [n] found)
+        found = np.array([key in self.entries for key in keys], dtype=bool)
+        if self.shape is None or not found.any():
+            return None, found
+        self._map()
+        feat = np.zeros((len(keys),) + self.shape, dtype=np.float32)
+        for i in np.nonzero(found)[0]:
+            slot = self.entries[keys[i]][0]
+            self._touch(keys[i], slot, clock)
+            feat[i] = self.data[slot]
+        return feat, found
+
+    def put(self, keys, feat, clock, budget):
+        # store the entries, the file grows by at most budget bytes
+        if self.shape is None:
+            self.shape = tuple(feat.shape[1:])
+            self.meta['shape'] = list(self.shape)
+        self._map()
+        for key, value in zip(keys, feat):
+            if key in self.entries:
+                self._touch(key, self.entries[key][0], clock)
+                continue
+            if not self.free:
+                num_new = min(max(self.num_slots, 256), budget // self.entry_bytes())
+                if num_new > 0:
+                    budget -= num_new * self.entry_bytes()
+                    self._grow(self.num_slots + num_new)
+                elif not self._evict():
+                    # an empty store at the limit still holds one entry
+                    budget -= self.entry_bytes()
+                    self._grow(self.num_slots + 1)
+            slot = self.free.pop()
+            self.data[slot] = value
+            self._touch(key, slot, clock)
+        return budget
+
+    def compact(self):
+        # move the entries to the first slots and truncate the file to them
+        num_entries = len(self.entries)
+        if self.num_slots > num_entries:
+            self._map()
+            free = [slot for slot in self.free if slot < num_entries]
+            for entry in self.entries.values():
+                if entry[0] >= num_entries:
+                    slot = free.pop()
+                    self.data[slot] = self.data[entry[0]]
+                    entry[0] = slot
+            self.flush()
+            self.data = None
+            with open(self.filename, 'r+b') as f:
+                f.truncate(num_entries * self.entry_bytes())
+            self.num_slots = num_entries
+            self.free = []
+
+    def flush(self):
+        if self.data is not None:
+            self.data.flush()
+
+
+class ActivationCache(object):
+    """Activations of single images for one model and one transform.
+
+    lookup() and put() take a batch of image paths and the aligned list of
+    layers, the layers can have a spatial reduction (see
+    engine.reduce_feature). hits and misses count the images which were,
+    or were not, found for all the layers of a lookup.
+    """
+
+    def __init__(self, root, model_digest, transform='', max_bytes=8 * 2**30, key='path'):
+        self.root = root
+        self.model_digest = model_digest
+        self.transform = str(transform)
+        self.max_bytes = max_bytes
+        self.key = content_key if key == 'content' else image_key
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.index_file = os.path.join(root, 'index.json')
+        self.index = {'clock': 0, 'stores': {}}
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        self.stores = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _store(self, layer, reduction=None):
+        config = json.dumps([self.model_digest, layer, reduction, self.transform])
+        name = hashlib.sha1(config.encode('utf-8')).hexdigest()[:16]
+        if name not in self.stores:
+            meta = self.index['stores'].get(name, {'layer': layer, 'reduction': reduction})
+            self.stores[name] = _Store(self.root, name, dict(meta))
+        return self.stores[name]
+
+    def _tick(self):
+        self.index['clock'] += 1
+        return self.index['clock']
+
+    def keys(self, paths):
+        return [self.key(path) for path in paths]
+
+    def lookup(self, paths, layers, reductions=None, keys=None):
+        """(features, found) of a batch of images.
+
+        features is aligned with layers, [n, ...] float32 arrays or None for a
+        layer with nothing cached yet, found is bool [n], True for the images
+        cached for all the layers.
+        """
+        reductions = reductions or {}
+        keys = keys or self.keys(paths)
+        with self.lock:
+            clock = self._tick()
+            features = []
+            found = np.ones(len(keys), dtype=bool)
+            for layer in layers:
+                feat, found_layer = self._store(layer, reductions.get(layer)).get(keys, clock)
+                features.append(feat)
+                found &= found_layer
+            num_found = int(found.sum())
+            self.hits += num_found
+            self.misses += len(keys) - num_found
+        return features, found
+
+    def put(self, paths, layers, features, reductions=None, keys=None):
+        # store the activations [n, ...] of a batch, aligned with layers
+        reductions = reductions or {}
+        keys = keys or self.keys(paths)
+        with self.lock:
+            clock = self._tick()
+            for layer, feat in zip(layers, features):
+                store = self._store(layer, reductions.get(layer))
+                # the stores of earlier runs count too, their files are on disk
+                self._load_stores()
+                budget = self.max_bytes - sum(other.file_bytes() for other in self.stores.values())
+                store.put(keys, np.asarray(feat, dtype=np.float32), clock, max(budget, 0))
+
+    def _load_stores(self):
+        # every store of the index, also the ones not used in this run
+        for name, meta in self.index['stores'].items():
+            if name not in self.stores:
+                self.stores[name] = _Store(self.root, name, dict(meta))
+
+    def save(self):
+        with self.lock:
+            self._load_stores()
+            entries = [(used, name, key) for name, store in self.stores.items()
+                       for key, (slot, used) in store.entries.items()]
+            total = sum(self.stores[name].entry_bytes() for used, name, key in entries)
+            if total > self.max_bytes:
+                # drop the least recently used entries of all the stores, the files are truncated below
+                for used, name, key in sorted(entries):
+                    if total <= self.max_bytes:
+                        break
+                    store = self.stores[name]
+                    store.free.append(store.entries.pop(key)[0])
+                    total -= store.entry_bytes()
+            stores = {}
+            for name, store in self.stores.items():
+                store.compact()
+                store.flush()
+                meta = dict(store.meta)
+                meta['entries'] = store.entries
+                meta['num_slots'] = store.num_slots
+                stores[name] = meta
+            self.index['stores'] = stores
+            with open(self.index_file + '.tmp', 'w') as f:
+                json.dump(self.index, f)
+            os.replace(self.index_file + '.tmp', self.index_file)
+
+    def report(self):
+        num_entries = sum(len(store.entries) for store in self.stores.values())
+        print('activation cache: %d hits, %d misses, %d entries' % (self.hits, self.misses, num_entries))
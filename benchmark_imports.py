@@ -0,0 +1,42 @@
+# import time of the modules of the toolkit
+# every module is imported in a fresh interpreter with python -X importtime,
+# the best of a few runs is reported with the heavy optional packages it pulls
+# in, to catch an import creeping back to the top of a module.
+#   python benchmark_imports.py [module ...]
+
+import sys
+import subprocess
+
+modules = ['dataset', 'tightcrop', 'featurestore', 'engine', 'pipeline', 'unittopk', 'montage',
+           'thumbcache', 'actcache', 'unitmax', 'modelcache', 'rfsegment', 'empiricalrf']
+# packages which should only be imported on the code paths that use them
+heavy = ['pandas', 'matplotlib', 'scipy.misc', 'scipy.spatial', 'torchvision', 'h5py', 'pdb']
+num_runs = 3
+
+
+def import_time(module):
+    """(cumulative import time in seconds, names of all the modules imported) of module."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import %s' % module],
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        raise RuntimeError('import %s failed:\n%s' % (module, result.stderr))
+    imported = []
+    total = 0.0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        imported.append(name.strip())
+        if name.strip() == module:
+            total = int(cumulative_us) / 1e6
+    return total, imported
+
+
+if __name__ == '__main__':
+    for module in sys.argv[1:] or modules:
+        times = []
+        for i in range(num_runs):
+            seconds, imported = import_time(module)
+            times.append(seconds)
+        pulled = [name for name in heavy if name in imported]
+        print('%-14s %7.3fs  %s' % (module, min(times), ', '.join(pulled)))
@@ -1,18 +1,17 @@
 import os
 import os.path
-import torch
-import pandas as pd
 
 import torch.utils.data as data
-import torchvision.transforms as transforms
 from PIL import Image
 
 IMG_EXTENSIONS = ['.png', '.jpg']
 
 
 def default_inception_transform(img_size):
+    # torchvision is only imported here, the DataLoader workers don't need it
+    import torchvision.transforms as transforms
     tf = transforms.Compose([
-        transforms.Scale(img_size),
+        transforms.Resize(img_size),
         transforms.CenterCrop(img_size),
         transforms.ToTensor(),
         LeNormalize(),
@@ -23,7 +22,7 @@ def default_inception_transform(img_size):
 
 class Dataset(data.Dataset):
 
-    def __init__(self,imglist,transform=None):
+    def __init__(self,imglist,transform=None,thumbnail_size=None):
 
         if len(imglist) == 0:
             raise(RuntimeError("Found 0 images in subfolders of: " + root + "\n"
@@ -31,13 +30,22 @@ class Dataset(data.Dataset):
 
         self.imgs = imglist
         self.transform = transform
+        # also return the image resized to thumbnail_size (w, h) as uint8 BGR,
+        # to fill the thumbnail cache while the images are decoded anyway
+        self.thumbnail_size = thumbnail_size
 
     def __getitem__(self, index):
         path = self.imgs[index]
         target = None
         img = Image.open(path).convert('RGB')
+        if self.thumbnail_size is not None:
+            # the same decoding as a miss of the thumbnail cache
+            from thumbcache import make_thumbnail
+            thumbnail = make_thumbnail(img, self.thumbnail_size)
         if self.transform is not None:
             img = self.transform(img)
+        if self.thumbnail_size is not None:
+            return img, path, thumbnail
         return img, path
 
     def __len__(self):
@@ -0,0 +1,185 @@
+# empirical receptive field of the units by occlusion
+# the synthetic receptive field of rfsegment.py assumes one size for all the
+# units of a layer. OcclusionRF measures it per unit as in the ICLR'15 paper:
+# an occluder slides over a top image of the unit, and the positions where
+# covering the image changes the activation of the unit at its max location
+# make up its receptive field. All the occluded copies of an image go
+# through the network in large batches, only up to the layer (EarlyExit),
+# and one pass over an image serves every unit which has it in its top
+# images. The size of a unit is the mean over its top images of the
+# diameter of the disk with the area of the positions above threshold * the
+# largest change, less the blur of the occluder: the change map is the
+# receptive field convolved with the occluder, and their widths at half
+# maximum add in quadrature as for Gaussians, d^2 = rf^2 + 8 ln2 / 12 *
+# occluder^2. A receptive field much smaller than the occluder is still
+# overestimated, the occluder should be smaller than the sizes of interest.
+#
+# EmpiricalRF keeps the sizes in one JSON file per (model weights, layer,
+# settings), so a unit is only estimated once, and rf_banks() turns them into
+# the mask banks of rfsegment.py for the segmentation.
+
+import os
+import json
+import numpy as np
+import torch
+
+import engine
+
+# version of the size estimate in the cache files, sizes of an older estimate are measured again
+version = 2
+
+
+def occluder_positions(image_size, occluder_size, stride):
+    # [n, 2] (y, x) of the top left corner of the occluder, and the (rows, cols) of the grid
+    ys = np.arange(0, image_size[0] - occluder_size + 1, stride)
+    xs = np.arange(0, image_size[1] - occluder_size + 1, stride)
+    grid_y, grid_x = np.meshgrid(ys, xs, indexing='ij')
+    return np.stack([grid_y.ravel(), grid_x.ravel()], 1), (len(ys), len(xs))
+
+
+def occlude(image, positions, occluder_size, fill=0.0):
+    """[n, 3, h, w] copies of image [3, h, w], the i-th covered at positions[i] by a square of fill."""
+    height, width = image.shape[1:]
+    positions = torch.as_tensor(positions, device=image.device)
+    ys = torch.arange(height, device=image.device)
+    xs = torch.arange(width, device=image.device)
+    in_y = (ys >= positions[:, :1]) & (ys < positions[:, :1] + occluder_size)
+    in_x = (xs >= positions[:, 1:]) & (xs < positions[:, 1:] + occluder_size)
+    masks = (in_y[:, :, None] & in_x[:, None, :]).unsqueeze(1)
+    return torch.where(masks, image.new_tensor(fill), image.unsqueeze(0))
+
+
+class OcclusionRF(object):
+    """Change of the units of a layer when an occluder covers each part of an image.
+
+    The input is normalized, so the default fill of 0 is the mean pixel.
+    """
+
+    def __init__(self, model, layer, device, channels_last=True, occluder_size=11, stride=3,
+                 batch_size=256, fill=0.0):
+        self.model = model
+        self.device = device
+        self.channels_last = channels_last
+        self.occluder_size = occluder_size
+        self.stride = stride
+        self.batch_size = batch_size
+        self.fill = fill
+        self.capture = engine.FeatureCapture(model, [layer])
+        self.early_exit = engine.EarlyExit(self.capture.modules)
+
+    def _forward(self, input):
+        engine.forward(self.model, input, self.device, self.channels_last)
+        return self.capture.pop()[0]
+
+    def discrepancy(self, image, units):
+        """[len(units), rows, cols] change of every unit at its max location, for each occluder position."""
+        image = image.to(self.device)
+        units = torch.as_tensor(units, device=self.device)
+        feat = self._forward(image.unsqueeze(0))[0, units]
+        width = feat.shape[2]
+        location = feat.flatten(1).argmax(1)
+        rows, cols = location // width, location % width
+        base = feat[torch.arange(len(units), device=self.device), rows, cols]
+
+        positions, grid = occluder_positions(image.shape[1:], self.occluder_size, self.stride)
+        changes = []
+        for start in range(0, len(positions), self.batch_size):
+            batch = occlude(image, positions[start:start + self.batch_size], self.occluder_size, self.fill)
+            feat = self._forward(batch)
+            changes.append((feat[:, units, rows, cols] - base).abs())
+        return torch.cat(changes).t().reshape((len(units),) + grid)
+
+    def diameters(self, image, units, threshold=0.5):
+        # [len(units)] diameter in pixels of the region changing the unit, nan if nothing changes
+        changes = self.discrepancy(image, units).flatten(1)
+        peak = changes.max(1, keepdim=True)[0]
+        area = (changes > threshold * peak).sum(1).float() * self.stride ** 2
+        # the width of the change map is the one of the receptive field blurred by the occluder
+        blur = 8 * np.log(2) / 12 * self.occluder_size ** 2
+        diameters = torch.sqrt((4 * area / np.pi - blur).clamp(min=0))
+        diameters[peak[:, 0] == 0] = float('nan')
+        return diameters.cpu().numpy()
+
+    def remove(self):
+        self.early_exit.remove()
+        self.capture.remove()
+
+
+class EmpiricalRF(object):
+    """Receptive field sizes of the units, estimated by occlusion and cached on disk."""
+
+    def __init__(self, root, model_digest, occluder_size=11, stride=3, threshold=0.5, num_images=5,
+                 batch_size=256):
+        self.root = root
+        self.model_digest = model_digest
+        self.settings = {'occluder_size': occluder_size, 'stride': stride, 'threshold': threshold,
+                         'num_images': num_images}
+        self.batch_size = batch_size
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def filename(self, layer, image_size):
+        settings = '_'.join('%s' % self.settings[key] for key in sorted(self.settings))
+        return os.path.join(self.root, 'empirical_v%d_%s_%s_%dx%d_%s.json' % (
+            version, self.model_digest[:16], layer, image_size[0], image_size[1], settings))
+
+    def load(self, layer, image_size):
+        # unit id -> size of the units estimated so far
+        filename = self.filename(layer, image_size)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as f:
+            return {int(unitID): size for unitID, size in json.load(f)['sizes'].items()}
+
+    def save(self, layer, image_size, sizes):
+        filename = self.filename(layer, image_size)
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'settings': self.settings, 'sizes': {str(unitID): size for unitID, size in sizes.items()}}, f)
+        os.replace(filename + '.tmp', filename)
+
+    def estimate(self, model, device, layer, dataset, indices, channels_last=True):
+        """[units] receptive field diameters in input pixels, nan for a dead unit.
+
+        indices [units, k] are the top images of every unit in dataset, which
+        gives the transformed images. Only the units not in the cache are
+        estimated, each of their top images is occluded once for all of them.
+        """
+        image_size = tuple(dataset[int(indices[0, 0])][0].shape[1:])
+        sizes = self.load(layer, image_size)
+        todo = [unitID for unitID in range(len(indices)) if unitID not in sizes]
+        if todo:
+            top = np.asarray(indices)[todo, :self.settings['num_images']]
+            image_ids = np.unique(top)
+            print('%s: receptive field of %d units from %d images' % (layer, len(todo), len(image_ids)))
+            estimator = OcclusionRF(model, layer, device, channels_last, self.settings['occluder_size'],
+                                    self.settings['stride'], self.batch_size)
+            diameters = {unitID: [] for unitID in todo}
+            try:
+                for i, imageID in enumerate(image_ids):
+                    rows = np.nonzero((top == imageID).any(1))[0]
+                    units = [todo[row] for row in rows]
+                    values = estimator.diameters(dataset[int(imageID)][0], units, self.settings['threshold'])
+                    for unitID, value in zip(units, values):
+                        diameters[unitID].append(value)
+                    print('%d / %d' % (i + 1, len(image_ids)))
+            finally:
+                estimator.remove()
+            for unitID in todo:
+                values = [value for value in diameters[unitID] if not np.isnan(value)]
+                sizes[unitID] = float(np.mean(values)) if values else None
+            self.save(layer, image_size, sizes)
+        return np.array([np.nan if sizes[unitID] is None else sizes[unitID] for unitID in range(len(indices))])
+
+
+def rf_banks(root, layer, sizes, grid_size, image_size, scale=1.0, step=8):
+    """The mask bank file of every unit for its receptive field size.
+
+    The sizes in input pixels are scaled to image_size and rounded to step
+    pixels, so the units share a few banks. A dead unit gets the median size.
+    """
+    import rfsegment
+    sizes = np.asarray(sizes, dtype=np.float64) * scale
+    sizes[np.isnan(sizes)] = np.nanmedian(sizes) if not np.isnan(sizes).all() else image_size[0]
+    sizes = np.maximum(np.round(sizes / step) * step, step)
+    files = {size: rfsegment.mask_bank_file(root, layer, grid_size, image_size, size) for size in np.unique(sizes)}
+    return [files[size] for size in sizes]
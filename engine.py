@@ -0,0 +1,312 @@
+# device agnostic engine to run the forward passes of the CNN
+# the same code runs on a GPU or on many-core CPU nodes: the model and the
+# input batches are moved to the chosen device, the forward pass runs under
+# torch.inference_mode, and on the CPU the intra-op/inter-op thread pools,
+# the channels_last memory format and the core of every DataLoader worker
+# can be tuned. Throughput keeps track of the images/sec of a configuration.
+# The hooks can reduce the [B, C, H, W] feature maps over space before they
+# leave the device, see reduce_feature(), and EarlyExit stops the forward pass
+# as soon as the deepest requested layer has run. Layers are named by their
+# dotted path in the model, e.g. 'layer4' or 'layer3.1.conv2', and
+# FeatureCapture keeps the outputs of any number of them in one forward pass.
+# ModelSeries puts several models behind one forward pass, so a batch is
+# decoded and moved to the device once for all of them.
+
+import os
+import time
+from collections import OrderedDict
+import torch
+
+
+def get_device(device=None):
+    # the GPU if there is one, unless asked otherwise
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def plan_cpu(num_workers, num_threads=None):
+    """Split the cores between the forward pass and the DataLoader workers.
+
+    Returns (num_threads, worker_cores): the workers get the last
+    num_workers cores, one each, and the intra-op pool the rest.
+    """
+    cores = available_cores()
+    worker_cores = cores[len(cores) - num_workers:] if 0 < num_workers < len(cores) else []
+    if num_threads is None:
+        num_threads = max(1, len(cores) - len(worker_cores))
+    return num_threads, worker_cores
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # it can only be set once, before any inter-op parallel work
+            print('the number of inter-op threads is already set to %d' % torch.get_num_interop_threads())
+
+
+def pin_workers(worker_cores):
+    """worker_init_fn for the DataLoader which pins worker i to worker_cores[i]."""
+    def worker_init_fn(worker_id):
+        if worker_cores and hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, [worker_cores[worker_id % len(worker_cores)]])
+        # decoding is single threaded per worker, don't oversubscribe the core
+        torch.set_num_threads(1)
+    return worker_init_fn
+
+
+def prepare_model(model, device, channels_last=True):
+    model.eval()
+    model = model.to(device)
+    memory_format = torch.channels_last if channels_last else torch.contiguous_format
+    return model.to(memory_format=memory_format)
+
+
+def add_engine_args(parser):
+    # the command line options of the device and the CPU thread pools, the same in every script
+    parser.add_argument('--device', default=None, help='cuda or cpu, the GPU is used if there is one')
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads, all the cores left by the workers by default')
+    parser.add_argument('--num_interop_threads', type=int, default=None, help='inter-op threads')
+    parser.add_argument('--channels_last', type=int, default=1, help='run the convolutions in the channels_last memory format')
+    return parser
+
+
+def setup_engine(args, model, num_workers):
+    """Put model on the device of the add_engine_args() options args.
+
+    Returns (model, device, num_threads, worker_cores), on the CPU the
+    intra-op pool gets the cores left by the num_workers DataLoader workers,
+    see plan_cpu(), and worker_cores goes to pin_workers().
+    """
+    device = get_device(args.device)
+    num_threads, worker_cores = plan_cpu(num_workers, args.num_threads)
+    if device.type == 'cpu':
+        configure_threads(num_threads, args.num_interop_threads)
+    return prepare_model(model, device, args.channels_last), device, num_threads, worker_cores
+
+
+class StopForward(Exception):
+    pass
+
+
+class EarlyExit(object):
+    """Stop the forward pass once all the given modules have produced their output.
+
+    The layers after the deepest hooked one (e.g. avgpool and fc when only
+    layer4 is extracted) are never run. Register it after the hooks which
+    capture the features, so they still see the output of the last module.
+    """
+
+    def __init__(self, modules):
+        self.num_modules = len(modules)
+        self.seen = set()
+        self.enabled = True
+        self.handles = [module.register_forward_hook(self.hook) for module in modules]
+
+    def hook(self, module, input, output):
+        if not self.enabled:
+            return
+        self.seen.add(id(module))
+        if len(self.seen) == self.num_modules:
+            self.seen.clear()
+            raise StopForward()
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+class ModelSeries(torch.nn.Module):
+    """Run the same input through several models, e.g. the snapshots of a training run.
+
+    The layers of model i are at 'models.i.<path>' for FeatureCapture, and an
+    EarlyExit on one model only cuts that model short, the next one still runs.
+    """
+
+    def __init__(self, models):
+        super(ModelSeries, self).__init__()
+        self.models = torch.nn.ModuleList(models)
+
+    def forward(self, input):
+        for model in self.models:
+            try:
+                model(input)
+            except StopForward:
+                pass
+
+
+def forward(model, input, device, channels_last=True):
+    """Output of model on input, or None if the pass was cut short by EarlyExit."""
+    input = input.to(device, non_blocking=True)
+    if channels_last:
+        input = input.contiguous(memory_format=torch.channels_last)
+    with torch.inference_mode():
+        try:
+            return model(input)
+        except StopForward:
+            return None
+
+
+def reduce_feature(feat, reduction=None):
+    """Spatial reduction of a [B, C, H, W] feature, done in torch on its device.
+
+    reduction is one of
+      None      the full feature map
+      'max'     [B, C] max over space
+      'mean'    [B, C] mean over space
+      'topk:k'  [B, C, k] the k largest values over space, largest first
+      'argmax'  [B, C, 2] (row, col) of the max over space
+    """
+    if reduction is None or feat.dim() != 4:
+        return feat
+    flat = feat.flatten(2)
+    if reduction == 'max':
+        return flat.max(2)[0]
+    if reduction == 'mean':
+        return flat.mean(2)
+    if reduction.startswith('topk:'):
+        k = min(int(reduction.split(':')[1]), flat.shape[2])
+        return flat.topk(k, dim=2)[0]
+    if reduction == 'argmax':
+        idx = flat.argmax(2)
+        return torch.stack([idx // feat.shape[3], idx % feat.shape[3]], 2)
+    raise ValueError('Unknown reduction %s' % reduction)
+
+
+def cast_feature(feat, dtype=None):
+    """A float32 feature in the storage dtype of featurestore.py, done in torch on its device.
+
+    dtype is None or 'float32' (unchanged), 'float16' or 'bfloat16'. numpy
+    has no bfloat16, so bfloat16 comes back as its bits in an int16 tensor,
+    which featurestore.encode() takes as its uint16 storage.
+    """
+    if dtype is None or dtype == 'float32' or not feat.is_floating_point():
+        return feat
+    if dtype == 'float16':
+        return feat.half()
+    if dtype == 'bfloat16':
+        return feat.to(torch.bfloat16).view(torch.int16)
+    raise ValueError('Unknown dtype %s' % dtype)
+
+
+def capture_feature(output, reduction=None, dtype=None):
+    # what a hook keeps of a layer output, still on the device: reduced over
+    # space, float32 or the storage dtype, and a 1x1 map (e.g. avgpool) as [B, C]
+    feat = reduce_feature(output, reduction)
+    if feat.dim() == 4 and feat.shape[2] == 1 and feat.shape[3] == 1:
+        feat = feat.flatten(1)
+    if feat.is_floating_point():
+        feat = cast_feature(feat.float(), dtype)
+    if feat.data_ptr() == output.data_ptr():
+        # still the memory of the output, which a later in-place op (e.g. ReLU(inplace=True)) overwrites
+        feat = feat.clone()
+    return feat
+
+
+def get_module(model, path):
+    # module of model at a dotted path like 'layer3.1.conv2'
+    module = model
+    for name in path.split('.'):
+        if name not in module._modules:
+            raise KeyError('%s has no layer %s, the layers are: %s' % (
+                type(model).__name__, path, ', '.join(name for name, _ in model.named_modules() if name)))
+        module = module._modules[name]
+    return module
+
+
+class FeatureCapture(object):
+    """Forward hooks on the layers at the given dotted paths.
+
+    The outputs of a forward pass are kept by layer name, so the order in
+    which the hooks fire does not matter. reductions maps a layer name to its
+    spatial reduction (see reduce_feature) and dtypes to the dtype it is cast
+    to on the device (see cast_feature), both can be changed between passes.
+    """
+
+    def __init__(self, model, names, reductions=None, dtypes=None):
+        self.names = list(names)
+        self.reductions = dict(reductions or {})
+        self.dtypes = dict(dtypes or {})
+        self.features = OrderedDict()
+        self.modules = [get_module(model, name) for name in self.names]
+        self.handles = [module.register_forward_hook(self._hook(name))
+                        for name, module in zip(self.names, self.modules)]
+
+    def _hook(self, name):
+        def hook(module, input, output):
+            self.features[name] = capture_feature(output, self.reductions.get(name), self.dtypes.get(name))
+        return hook
+
+    def pop(self):
+        # the features of the last forward pass, aligned with names
+        features = [self.features[name] for name in self.names]
+        self.features.clear()
+        return features
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def describe(device, channels_last=True):
+    # short text for the configuration in the throughput reports
+    config = '%s' % device
+    if device.type == 'cpu':
+        config += ' threads=%d interop=%d' % (torch.get_num_threads(), torch.get_num_interop_threads())
+    if channels_last:
+        config += ' channels_last'
+    return config
+
+
+class Throughput(object):
+
+    def __init__(self, config=''):
+        self.config = config
+        self.restart()
+
+    def restart(self):
+        # the clock starts here, every batch of update() is counted
+        self.num_images = 0
+        self.start = time.time()
+
+    def update(self, num_images):
+        self.num_images += num_images
+
+    def images_per_sec(self):
+        if self.num_images == 0:
+            return 0.0
+        return self.num_images / (time.time() - self.start)
+
+    def report(self):
+        print('%s: %.1f images/sec' % (self.config, self.images_per_sec()))
+
+
+def benchmark(model, input, device, configs, num_iters=10):
+    """images/sec of the forward pass on one batch for each (num_threads, channels_last) in configs."""
+    results = []
+    for num_threads, channels_last in configs:
+        configure_threads(num_threads)
+        model = prepare_model(model, device, channels_last)
+        meter = Throughput(describe(device, channels_last))
+        for i in range(num_iters + 1):
+            forward(model, input, device, channels_last)
+            if device.type == 'cuda':
+                torch.cuda.synchronize()
+            if i == 0:
+                # the first pass is a warm up, it is not counted
+                meter.restart()
+                continue
+            meter.update(input.shape[0])
+        meter.report()
+        results.append((num_threads, channels_last, meter.images_per_sec()))
+    return results
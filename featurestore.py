@@ -0,0 +1,258 @@
+# on-disk store for the extracted CNN features
+# every layer goes to its own .npy file which is memory-mapped and filled batch
+# by batch, so the peak memory only depends on the batch size, not on the
+# number of images. Load it back with load_features() or simply
+# np.load('<root>/<layer>.npy', mmap_mode='r').
+# The storage dtype can be chosen per layer: float32, float16 or bfloat16.
+# numpy has no bfloat16, so those layers are kept as the upper 16 bits of the
+# float32 values (uint16) and turned back into float32 by decode().
+# A manifest.json next to the layer files records which row ranges are
+# already on disk, so an interrupted run can be resumed from the first
+# missing batch and the layer files are the final result, no merge needed.
+# Large image lists can be split with shard_range() into N contiguous slices,
+# each one written to its own store by a separate process or machine, and
+# merge_shards() puts them back together in the order of the image list.
+
+import os
+import json
+import numpy as np
+
+
+STORAGE_DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.uint16}
+
+
+def layer_filename(root, name):
+    return os.path.join(root, '%s.npy' % name)
+
+
+def parse_shard(shard):
+    # 'i/N' -> (i, N), i counts from 0
+    shard_id, num_shards = [int(x) for x in shard.split('/')]
+    if not 0 <= shard_id < num_shards:
+        raise ValueError('shard should be i/N with 0 <= i < N, got %s' % shard)
+    return shard_id, num_shards
+
+
+def shard_range(num_images, shard):
+    """Rows [start, end) of the image list processed by shard 'i/N'."""
+    shard_id, num_shards = parse_shard(shard)
+    return shard_id * num_images // num_shards, (shard_id + 1) * num_images // num_shards
+
+
+def shard_root(root, shard):
+    shard_id, num_shards = parse_shard(shard)
+    return '%s_shard%dof%d' % (root, shard_id, num_shards)
+
+
+def merge_ranges(ranges):
+    # union of [start, end) ranges, sorted and with touching ranges joined
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+def encode(feat, dtype='float32'):
+    # cast float32 activations to the storage dtype, activations already
+    # cast on the device by engine.cast_feature() are only viewed as it
+    feat = np.asarray(feat)
+    if dtype == 'bfloat16' and feat.dtype == np.int16:
+        return feat.view(np.uint16)
+    if feat.dtype == STORAGE_DTYPES[dtype]:
+        return feat
+    if dtype == 'bfloat16':
+        bits = np.ascontiguousarray(feat, dtype=np.float32).view(np.uint32)
+        # round to nearest even on the dropped 16 bits
+        bits = bits + (0x7fff + ((bits >> 16) & 1))
+        return (bits >> 16).astype(np.uint16)
+    return np.asarray(feat, dtype=STORAGE_DTYPES[dtype])
+
+
+def decode(feat, dtype='float32'):
+    # back to float32 from the storage dtype
+    if dtype == 'bfloat16':
+        feat = encode(feat, dtype)
+        return (np.asarray(feat, dtype=np.uint32) << 16).view(np.float32)
+    return np.asarray(feat, dtype=np.float32)
+
+
+def precision_report(feat, dtypes=('float16', 'bfloat16')):
+    """Error of storing the float32 array feat in each of dtypes."""
+    feat = np.asarray(feat, dtype=np.float32)
+    scale = np.abs(feat).max() + 1e-12
+    report = {}
+    for dtype in dtypes:
+        diff = np.abs(decode(encode(feat, dtype), dtype) - feat)
+        finite = np.isfinite(diff)
+        report[dtype] = {
+            'max_abs_err': float(diff[finite].max()) if finite.any() else float('inf'),
+            'mean_abs_err': float(diff[finite].mean()) if finite.any() else float('inf'),
+            'max_rel_err': float(diff[finite].max() / scale) if finite.any() else float('inf'),
+            'overflow': int((~finite).sum())}
+    return report
+
+
+def print_precision_report(name, feat, dtypes=('float16', 'bfloat16')):
+    for dtype, err in precision_report(feat, dtypes).items():
+        print('%s %s: max abs err %.3g, mean abs err %.3g, max err / max value %.3g, overflow %d' % (
+            name, dtype, err['max_abs_err'], err['mean_abs_err'], err['max_rel_err'], err['overflow']))
+
+
+class FeatureWriter(object):
+
+    def __init__(self, root, features_names, num_images, features_dtypes=None, resume=False):
+        self.root = root
+        self.features_names = list(features_names)
+        self.num_images = num_images
+        # storage dtype per layer, float32 if not given
+        features_dtypes = features_dtypes or {}
+        self.features_dtypes = [features_dtypes.get(name, 'float32') for name in self.features_names]
+        self.features = [None] * len(self.features_names)
+        self.done = []      # row ranges [start, end) safely on disk
+        self.pending = []   # row ranges written since the last checkpoint
+        self.manifest_file = os.path.join(root, 'manifest.json')
+        if not os.path.exists(root):
+            os.makedirs(root)
+        if resume and os.path.exists(self.manifest_file):
+            self._resume()
+
+    def _resume(self):
+        with open(self.manifest_file) as f:
+            manifest = json.load(f)
+        if (manifest['features_names'] != self.features_names
+                or manifest['features_dtypes'] != self.features_dtypes
+                or manifest['num_images'] != self.num_images):
+            raise RuntimeError('The manifest in %s does not match the current setup, '
+                               'remove it to start from scratch' % self.root)
+        for i, name in enumerate(self.features_names):
+            if name in manifest['shapes']:
+                self.features[i] = np.load(layer_filename(self.root, name), mmap_mode='r+')
+        self.done = manifest['done']
+        print('resuming %s: %d / %d images done' % (
+            self.root, sum(end - start for start, end in self.done), self.num_images))
+
+    def todo(self, batch_size):
+        """Row ranges [start, end) of the batches that are not on disk yet."""
+        batches = []
+        for start in range(0, self.num_images, batch_size):
+            end = min(start + batch_size, self.num_images)
+            if not any(s <= start and end <= e for s, e in self.done):
+                batches.append((start, end))
+        return batches
+
+    def _open(self, i, feat_batch):
+        # the layer file is created the first time we see its shape
+        size_features = (self.num_images,) + feat_batch.shape[1:]
+        self.features[i] = np.lib.format.open_memmap(
+            layer_filename(self.root, self.features_names[i]), mode='w+',
+            dtype=STORAGE_DTYPES[self.features_dtypes[i]], shape=size_features)
+        print('%s %s %s' % (self.features_names[i], str(size_features), self.features_dtypes[i]))
+
+    def write(self, start_idx, features_batch):
+        # features_batch is aligned with features_names,
+        # batches not yet in the storage dtype are encoded here
+        for i, feat_batch in enumerate(features_batch):
+            if self.features[i] is None:
+                self._open(i, feat_batch)
+            if feat_batch.dtype != self.features[i].dtype:
+                feat_batch = encode(feat_batch, self.features_dtypes[i])
+            end_idx = start_idx + feat_batch.shape[0]
+            self.features[i][start_idx:end_idx] = feat_batch
+        self.pending.append([start_idx, end_idx])
+
+    def flush(self):
+        for feat in self.features:
+            if feat is not None:
+                feat.flush()
+
+    def checkpoint(self, complete=False):
+        # flush the layer files first, then record the ranges in the manifest
+        self.flush()
+        self.done = merge_ranges(self.done + self.pending)
+        self.pending = []
+        manifest = {'features_names': self.features_names,
+                    'features_dtypes': self.features_dtypes,
+                    'num_images': self.num_images,
+                    'shapes': dict((name, list(feat.shape)) for name, feat
+                                   in zip(self.features_names, self.features) if feat is not None),
+                    'done': self.done,
+                    'complete': complete}
+        # write to a temporary file and rename, so a crash never leaves a broken manifest
+        with open(self.manifest_file + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.manifest_file + '.tmp', self.manifest_file)
+
+    def close(self, imglist):
+        self.checkpoint(complete=True)
+        self.features = [None] * len(self.features_names)
+        with open(os.path.join(self.root, 'imglist.txt'), 'w') as f:
+            f.write('\n'.join(imglist))
+        with open(os.path.join(self.root, 'meta.json'), 'w') as f:
+            json.dump({'features_names': self.features_names,
+                       'features_dtypes': self.features_dtypes,
+                       'num_images': self.num_images}, f)
+
+
+def load_meta(root):
+    with open(os.path.join(root, 'meta.json')) as f:
+        meta = json.load(f)
+    meta.setdefault('features_dtypes', ['float32'] * len(meta['features_names']))
+    return meta
+
+
+def load_features(root, mmap_mode='r'):
+    """Return (features, imglist, features_names) of a store, features memory-mapped.
+
+    Features are returned in their storage dtype, use decode() with
+    load_meta(root)['features_dtypes'] to get float32 back.
+    """
+    meta = load_meta(root)
+    with open(os.path.join(root, 'imglist.txt')) as f:
+        imglist = [line.rstrip('\n') for line in f]
+    features_names = meta['features_names']
+    features = [np.load(layer_filename(root, name), mmap_mode=mmap_mode) for name in features_names]
+    return features, imglist, features_names
+
+
+def merge_shards(root, num_shards, chunk_size=1024, imglist=None, features_names=None):
+    """Concatenate the stores of shards 0/N ... N-1/N into the store root.
+
+    The shards are copied chunk_size rows at a time, so the merge runs in
+    bounded memory as well. When imglist and features_names are given, the
+    shards must be the scan of these images and layers, shard i/N of the
+    slice shard_range(len(imglist), 'i/N') of imglist.
+    """
+    roots = [shard_root(root, '%d/%d' % (i, num_shards)) for i in range(num_shards)]
+    for shard in roots:
+        if not os.path.exists(os.path.join(shard, 'meta.json')):
+            raise RuntimeError('Shard %s is not finished yet' % shard)
+    for i, shard in enumerate(roots):
+        if features_names is not None and load_meta(shard)['features_names'] != list(features_names):
+            raise RuntimeError('Shard %s has the layers %s instead of %s, scan it again' % (
+                shard, load_meta(shard)['features_names'], list(features_names)))
+        if imglist is not None:
+            start, end = shard_range(len(imglist), '%d/%d' % (i, num_shards))
+            with open(os.path.join(shard, 'imglist.txt')) as f:
+                imglist_shard = [line.rstrip('\n') for line in f]
+            if imglist_shard != imglist[start:end]:
+                raise RuntimeError('Shard %s was scanned with another image list, scan it again' % shard)
+    meta = load_meta(roots[0])
+    features_names = meta['features_names']
+    features_dtypes = dict(zip(features_names, meta['features_dtypes']))
+    num_images = sum(load_meta(shard)['num_images'] for shard in roots)
+
+    writer = FeatureWriter(root, features_names, num_images, features_dtypes)
+    imglist = []
+    for shard in roots:
+        features, imglist_shard, names_shard = load_features(shard)
+        if names_shard != features_names:
+            raise RuntimeError('Shard %s has the layers %s instead of %s' % (shard, names_shard, features_names))
+        offset = len(imglist)
+        for start in range(0, len(imglist_shard), chunk_size):
+            writer.write(offset + start, [feat[start:start + chunk_size] for feat in features])
+        imglist += imglist_shard
+    writer.close(imglist)
+    return root
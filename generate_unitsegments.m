@@ -61,26 +61,58 @@ if matlabpool('size')==0
     end
 end
 
-if ~exist('layers_unitMax','var')
-    % get the network architecture
-    layernames = net.blob_names;
-    netInfo = cell(size(layernames,1),3);
-    for i=1:size(layernames,1)
-        netInfo{i,1} = layernames{i};
-        netInfo{i,2} = i;
-        tmp = net.blobs(layernames{i}).shape;
-        if tmp(1) == 1
-            tmp = tmp(3:end);
+% get the network architecture
+layernames = net.blob_names;
+netInfo = cell(size(layernames,1),3);
+for i=1:size(layernames,1)
+    netInfo{i,1} = layernames{i};
+    netInfo{i,2} = i;
+    tmp = net.blobs(layernames{i}).shape;
+    if tmp(1) == 1
+        tmp = tmp(3:end);
+    end
+    netInfo{i,3} = tmp;
+end
+IMAGE_MEAN = caffe.io.read_mean('model/places_mean.binaryproto');
+CROPPED_DIM = netInfo{1,3}(1); % alexNet is 227, googlenet input is 224
+IMAGE_MEAN = imresize(IMAGE_MEAN,[CROPPED_DIM CROPPED_DIM]);
+
+batch_size = netInfo{1,3}(4);
+num_batches = ceil(nImgs / batch_size);
+
+% the max activations are shared with pytorch_generate_unitsegments.py in an
+% HDF5 file, one nImgs x units dataset per layer. It is reused when it was
+% made for the same network, weights, preprocessing and image list.
+file_unitMax = sprintf('unitMax_%s.h5', network);
+preprocessing_unitMax = sprintf('caffe mean places_mean.binaryproto crop %d', CROPPED_DIM);
+md = java.security.MessageDigest.getInstance('SHA-1');
+imagelist_sha1 = lower(reshape(dec2hex(typecast(md.digest(uint8(strjoin(imageList', char(10)))), 'uint8'))', 1, []));
+% the weights are identified by the SHA-1 of the caffemodel file
+fid = fopen(net_binary, 'r');
+md_weights = java.security.MessageDigest.getInstance('SHA-1');
+md_weights.update(fread(fid, Inf, '*int8'));
+fclose(fid);
+weights_digest = lower(reshape(dec2hex(typecast(md_weights.digest(), 'uint8'))', 1, []));
+if ~exist('layers_unitMax','var') && exist(file_unitMax, 'file')
+    info_unitMax = h5info(file_unitMax);
+    if strcmp(deblank(h5readatt(file_unitMax, '/', 'imagelist_sha1')), imagelist_sha1) && ...
+            strcmp(deblank(h5readatt(file_unitMax, '/', 'model')), network) && ...
+            any(strcmp({info_unitMax.Attributes.Name}, 'weights_digest')) && ...
+            strcmp(deblank(h5readatt(file_unitMax, '/', 'weights_digest')), weights_digest) && ...
+            strcmp(deblank(h5readatt(file_unitMax, '/', 'preprocessing')), preprocessing_unitMax) && ...
+            all(ismember(layers, {info_unitMax.Datasets.Name}))
+        num_layers = numel(layers);
+        layers_unitMax = cell(num_layers,1);
+        num_units_layers = zeros(num_layers,1);
+        for i=1:num_layers
+            layers_unitMax{i} = h5read(file_unitMax, ['/' layers{i}]);
+            num_units_layers(i) = size(layers_unitMax{i}, 2);
         end
-        netInfo{i,3} = tmp;
+        disp(['the max activations are loaded from ' file_unitMax]);
     end
-    IMAGE_MEAN = caffe.io.read_mean('model/places_mean.binaryproto');
-    CROPPED_DIM = netInfo{1,3}(1); % alexNet is 227, googlenet input is 224
-    IMAGE_MEAN = imresize(IMAGE_MEAN,[CROPPED_DIM CROPPED_DIM]);
+end
 
-    batch_size = netInfo{1,3}(4);
-    num_batches = ceil(nImgs / batch_size);
-    
+if ~exist('layers_unitMax','var')
     %% feature extraction step
     num_layers = numel(layers);
     layers_unitMax = cell(num_layers,1);
@@ -114,6 +146,18 @@ if ~exist('layers_unitMax','var')
         disp([network  ' feature extraction:' num2str(curBatchID) '/' num2str(num_batches)]);
     end 
     save(sprintf('unitMax_%s.mat', network),'layers_unitMax','layers', '-v7.3')
+    if exist(file_unitMax, 'file')
+        delete(file_unitMax);
+    end
+    for i=1:num_layers
+        h5create(file_unitMax, ['/' layers{i}], size(layers_unitMax{i}), 'Datatype', 'single');
+        h5write(file_unitMax, ['/' layers{i}], layers_unitMax{i});
+    end
+    h5writeatt(file_unitMax, '/', 'model', network);
+    h5writeatt(file_unitMax, '/', 'weights_digest', weights_digest);
+    h5writeatt(file_unitMax, '/', 'preprocessing', preprocessing_unitMax);
+    h5writeatt(file_unitMax, '/', 'imagelist_sha1', imagelist_sha1);
+    h5writeatt(file_unitMax, '/', 'num_images', nImgs);
 end
     
 %% start segmentation given the top activations of each image.
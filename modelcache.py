@@ -0,0 +1,109 @@
+# fast startup of the pretrained WideResNet-18 of Places365
+# the released checkpoint is a state dict of nn.DataParallel ('module.' in
+# every key) for the layout of old pytorch versions, so building the model
+# from it means renaming every key, fixing the batchnorm layers and the
+# avgpool of the 14x14 layer4 at every launch. convert_model() does all of
+# that once and saves the ready state dict next to the checkpoint, then
+# load_model() only builds the network and maps the weights in: the
+# network is built on the meta device (no random init) and the
+# weights are memory-mapped from the converted file.
+# Both pytorch_extract_feature.py and pytorch_generate_unitsegments.py use it,
+# run "python modelcache.py" to do the conversion ahead of time.
+
+import os
+import torch
+import torch._utils
+
+
+# hacky way to load the new torch models with an old version of pytorch
+try:
+    torch._utils._rebuild_tensor_v2
+except AttributeError:
+    def _rebuild_tensor_v2(storage, storage_offset, size, stride, requires_grad, backward_hooks):
+        tensor = torch._utils._rebuild_tensor(storage, storage_offset, size, stride)
+        tensor.requires_grad = requires_grad
+        tensor._backward_hooks = backward_hooks
+        return tensor
+    torch._utils._rebuild_tensor_v2 = _rebuild_tensor_v2
+
+
+model_file = 'wideresnet18_places365.pth.tar'
+num_classes = 365
+avgpool_size = 14   # layer4 is 14x14 for 224x224 inputs
+
+
+def converted_filename(filename):
+    # wideresnet18_places365.pth.tar -> wideresnet18_places365_converted.pth
+    return filename.split('.pth')[0] + '_converted.pth'
+
+
+def download_code():
+    # the definition of the network
+    if not os.path.exists('wideresnet.py'):
+        os.system('wget https://raw.githubusercontent.com/csailvision/places365/master/wideresnet.py')
+
+
+def download(filename=model_file):
+    if not os.access(filename, os.W_OK):
+        os.system('wget http://places2.csail.mit.edu/models_places365/' + filename)
+    download_code()
+
+
+def recursion_change_bn(module):
+    # hacky way to deal with the Pytorch 1.0 update
+    if isinstance(module, torch.nn.BatchNorm2d):
+        module.track_running_stats = 1
+    else:
+        for i, (name, module1) in enumerate(module._modules.items()):
+            module1 = recursion_change_bn(module1)
+    return module
+
+
+def convert_model(filename=model_file, output=None):
+    """Save the state dict of the ready model from the released checkpoint, return its filename."""
+    output = output or converted_filename(filename)
+    import wideresnet
+    model = wideresnet.resnet18(num_classes=num_classes)
+    checkpoint = torch.load(filename, map_location='cpu', weights_only=False)
+    state_dict = {str.replace(k, 'module.', ''): v for k, v in checkpoint['state_dict'].items()}
+    model.load_state_dict(state_dict)
+    recursion_change_bn(model)
+    # write to a temporary file and rename, a half written file is never loaded
+    torch.save({'state_dict': model.state_dict(), 'num_classes': num_classes}, output + '.tmp')
+    os.replace(output + '.tmp', output)
+    print('converted %s to %s' % (filename, output))
+    return output
+
+
+def load_model(filename=model_file):
+    """The WideResNet-18 of Places365 in eval mode, converted on the first call.
+
+    The converted file is enough on its own, the checkpoint is only needed
+    to convert it, or to convert it again when the checkpoint is newer.
+    """
+    download_code()
+    converted = converted_filename(filename)
+    if os.path.exists(filename):
+        if not os.path.exists(converted) or os.path.getmtime(converted) < os.path.getmtime(filename):
+            convert_model(filename, converted)
+    elif not os.path.exists(converted):
+        if filename != model_file:
+            raise FileNotFoundError('neither %s nor %s exists' % (filename, converted))
+        # only the released checkpoint can be downloaded
+        download(filename)
+        convert_model(filename, converted)
+
+    import wideresnet
+    checkpoint = torch.load(converted, map_location='cpu', mmap=True, weights_only=True)
+    # no random init of the weights which are overwritten right away
+    with torch.device('meta'):
+        model = wideresnet.resnet18(num_classes=checkpoint['num_classes'])
+    model.load_state_dict(checkpoint['state_dict'], assign=True)
+    model.avgpool = torch.nn.AvgPool2d(kernel_size=avgpool_size, stride=1, padding=0)
+    model.eval()
+    return model
+
+
+if __name__ == '__main__':
+    download()
+    convert_model()
@@ -0,0 +1,276 @@
+# batched rendering of the unit segmentation montages
+# all the feature maps of a unit are upsampled and binarized in one tensor
+# op, the masks are applied to a preloaded uint8 batch of the top images and
+# the tiles are written straight into a preallocated canvas:
+#
+#   | image 1 | margin | image 2 | margin | ... | image k | margin |
+#
+# RenderPool renders and encodes the montages of many units in worker
+# processes, reading the feature maps of a layer from shared memory and,
+# with a thumbnail cache, the resized top images from its memory-mapped file.
+# With a receptive field mask bank (see rfsegment.py) a unit is segmented by
+# the synthetic receptive fields of its top positions instead of the
+# upsampled feature maps.
+
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import cv2
+import torch
+from torch.nn import functional as F
+
+from thumbcache import open_thumbnails, load_thumbnail
+
+
+def load_images(paths, segment_size):
+    # uint8 [n, h, w, 3] BGR batch of the images resized to segment_size (w, h)
+    images = np.zeros((len(paths), segment_size[1], segment_size[0], 3), dtype=np.uint8)
+    for i, path in enumerate(paths):
+        images[i] = load_thumbnail(path, segment_size)
+    return images
+
+
+def upsample_masks(maps, segment_size, threshold):
+    """Binary masks [n, h, w] of the feature maps [n, H, W], all in one go.
+
+    The maps are normalized by the max of the first map which is not all
+    zeros, the one of the top ranked image.
+    """
+    maps = torch.as_tensor(np.asarray(maps, dtype=np.float32))
+    max_values = maps.flatten(1).max(1)[0]
+    nonzero = (max_values != 0).nonzero()
+    max_value = max_values[nonzero[0, 0]] if len(nonzero) else max_values.new_tensor(1.0)
+    masks = F.interpolate((maps / max_value).unsqueeze(1), size=(segment_size[1], segment_size[0]),
+                          mode='bilinear', align_corners=False).squeeze(1).numpy()
+    # binarize the mask, a value right at the threshold is kept as it is
+    binary = (masks > threshold).astype(np.float32)
+    at_threshold = masks == threshold
+    binary[at_threshold] = masks[at_threshold]
+    return binary
+
+
+def normalize_table(images):
+    # per image lookup table uint8 -> [0, 1], the min-max normalization of cv2.normalize
+    flat = images.reshape(len(images), -1)
+    smin = flat.min(1).astype(np.float64)
+    smax = flat.max(1).astype(np.float64)
+    spread = smax - smin
+    scale = np.where(spread > np.finfo(np.float64).eps, 1.0 / np.maximum(spread, 1e-12), 0.0)
+    shift = -smin * scale
+    return np.arange(256)[np.newaxis, :] * scale[:, np.newaxis] + shift[:, np.newaxis]
+
+
+def render_montage(images, maps, threshold, margin, canvas=None, masks=None):
+    """Montage uint8 [h, n * (w + margin), 3] of the images [n, h, w, 3] segmented by maps [n, H, W].
+
+    masks are the upsample_masks() of maps, if they are already known.
+    """
+    num_images, height, width = images.shape[:3]
+    if masks is None:
+        masks = upsample_masks(maps, (width, height), threshold)
+    table = normalize_table(images)
+    # inside the mask the tile is the normalized image, a lookup per image
+    lut = np.uint8(table * 255)
+    tiles = np.stack([cv2.LUT(image, lut[i]) for i, image in enumerate(images)])
+    tiles *= (masks == 1)[:, :, :, np.newaxis]
+    # the rare pixels right at the threshold are scaled by the mask value
+    n, y, x = np.nonzero((masks != 0) & (masks != 1))
+    if len(n):
+        tiles[n, y, x] = np.uint8(table[n[:, np.newaxis], images[n, y, x]] * masks[n, y, x, np.newaxis] * 255)
+
+    if canvas is None:
+        canvas = np.empty((height, num_images * (width + margin), 3), dtype=np.uint8)
+    canvas.fill(255)
+    cells = canvas.reshape(height, num_images, width + margin, 3)
+    cells[:, :, :width] = tiles.transpose(1, 0, 2, 3)
+    return canvas
+
+
+class MontageRenderer(object):
+    """render_montage with fixed settings, the canvas is allocated once and reused.
+
+    The masks of the last montage are kept for the tight crop. With a mask
+    bank the positions of a map above rf_threshold * its max are segmented
+    by their receptive fields.
+    """
+
+    def __init__(self, segment_size, threshold, margin, rf_threshold=0.5):
+        self.segment_size = segment_size
+        self.threshold = threshold
+        self.margin = margin
+        self.rf_threshold = rf_threshold
+        self.canvas = None
+        self.masks = None
+
+    def render_images(self, images, maps, rf_bank=None):
+        shape = (self.segment_size[1], len(images) * (self.segment_size[0] + self.margin), 3)
+        if self.canvas is None or self.canvas.shape != shape:
+            self.canvas = np.empty(shape, dtype=np.uint8)
+        if rf_bank is not None:
+            import rfsegment
+            self.masks = rfsegment.segment(maps, rf_bank, (self.segment_size[1], self.segment_size[0]),
+                                           self.rf_threshold).astype(np.float32)
+        else:
+            self.masks = upsample_masks(maps, self.segment_size, self.threshold)
+        return render_montage(images, maps, self.threshold, self.margin, self.canvas, self.masks)
+
+
+def save_unit(renderer, output_folder, layer, unitID, images, unit_maps, flag_crop=0, rf_bank=None):
+    # render one unit from its top images and write its montage, and the tight crop if asked
+    montage_unit = renderer.render_images(images, unit_maps, rf_bank)
+    cv2.imwrite(os.path.join(output_folder, 'image', '%s-unit%03d.jpg'%(layer, unitID)), montage_unit)
+    if flag_crop == 1:
+        # load the library to crop image, the boxes come from the masks of the montage
+        import tightcrop
+        montage_unit_crop = tightcrop.crop_tiles(montage_unit, tightcrop.mask_boxes(renderer.masks), renderer.margin)
+        cv2.imwrite(os.path.join(output_folder, 'image', '%s-unit%03d_crop.jpg'%(layer, unitID)), montage_unit_crop)
+
+
+# state of a RenderPool worker process
+_worker = {}
+
+def _init_worker(segment_size, threshold, margin, flag_crop, rf_threshold):
+    # one process per core, no nested thread pools
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+    _worker['renderer'] = MontageRenderer(segment_size, threshold, margin, rf_threshold)
+    _worker['flag_crop'] = flag_crop
+    _worker['rf_banks'] = {}
+
+
+def _load_rf_bank(filename, banks):
+    # the mask bank in a file of rfsegment.mask_bank_file, loaded once
+    if filename is None:
+        return None
+    if filename not in banks:
+        import rfsegment
+        banks[filename] = rfsegment.load_mask_bank(filename)
+    return banks[filename]
+
+
+def _render_units(shm_name, shape, dtype, output_folder, layer, start, unit_ids, paths, thumbnails, rf_banks):
+    # unit unit_ids[i] has the maps [start + i] in shared memory and the top images paths[i],
+    # or their slots in the thumbnails (filename, num_slots), and the mask bank file rf_banks[i]
+    renderer = _worker['renderer']
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        maps = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        if thumbnails is not None:
+            thumbnails = open_thumbnails(thumbnails[0], thumbnails[1], renderer.segment_size)
+        for i, (unitID, paths_unit) in enumerate(zip(unit_ids, paths)):
+            if thumbnails is not None:
+                images = np.array(thumbnails[paths_unit])
+            else:
+                images = load_images(paths_unit, renderer.segment_size)
+            save_unit(renderer, output_folder, layer, unitID, images, maps[start + i], _worker['flag_crop'],
+                      _load_rf_bank(rf_banks[i], _worker['rf_banks']))
+        del maps
+    finally:
+        shm.close()
+    return len(unit_ids)
+
+
+class RenderPool(object):
+    """Render the montages of whole layers in num_workers processes.
+
+    The maps [units, k, H, W] of a layer are put once in shared memory and
+    the units are handed out in chunks. At most max_pending chunks are in
+    flight, submit_layer() waits for the oldest ones beyond that. With
+    num_workers = 0 the units are rendered in the calling process. With a
+    ThumbnailCache the top images are read from it instead of decoded.
+    """
+
+    def __init__(self, num_workers, segment_size, threshold, margin, flag_crop=0,
+                 chunk_size=16, max_pending=None, thumbnails=None, rf_threshold=0.5):
+        self.num_workers = num_workers
+        self.thumbnails = thumbnails
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or 4 * max(num_workers, 1)
+        self.flag_crop = flag_crop
+        self.pending = deque()   # (future, shared memory of its layer)
+        self.shms = {}           # shared memory name -> number of chunks not done yet
+        self.num_done = 0
+        self.rf_banks = {}
+        if num_workers > 0:
+            self.executor = ProcessPoolExecutor(num_workers, initializer=_init_worker,
+                                                initargs=(segment_size, threshold, margin, flag_crop, rf_threshold))
+        else:
+            self.executor = None
+            self.renderer = MontageRenderer(segment_size, threshold, margin, rf_threshold)
+
+    def submit_layer(self, output_folder, layer, maps, paths, unit_ids=None, rf_bank=None):
+        """Render unit u of layer from maps[u] and the images paths[u].
+
+        All the units are rendered, or only the ones in unit_ids. rf_bank is
+        the file of the receptive field mask bank of the layer, if any, or
+        the list of the files of every unit.
+        """
+        if unit_ids is None:
+            unit_ids = range(len(paths))
+        unit_ids = list(unit_ids)
+        if not unit_ids:
+            return
+        maps = maps[unit_ids]
+        paths = [paths[unitID] for unitID in unit_ids]
+        rf_banks = [rf_bank[unitID] if isinstance(rf_bank, list) else rf_bank for unitID in unit_ids]
+        thumbnails = None
+        if self.thumbnails is not None:
+            # decode the images missing from the cache once, the workers only read it
+            paths = [self.thumbnails.get_slots(paths_unit) for paths_unit in paths]
+            self.thumbnails.flush()
+            thumbnails = (self.thumbnails.filename, self.thumbnails.num_slots)
+        if self.executor is None:
+            for i, unitID in enumerate(unit_ids):
+                if self.thumbnails is not None:
+                    images = self.thumbnails.read(paths[i])
+                else:
+                    images = load_images(paths[i], self.renderer.segment_size)
+                save_unit(self.renderer, output_folder, layer, unitID, images, maps[i], self.flag_crop,
+                          _load_rf_bank(rf_banks[i], self.rf_banks))
+            self.num_done += len(unit_ids)
+            return
+
+        maps = np.ascontiguousarray(maps)
+        shm = shared_memory.SharedMemory(create=True, size=max(maps.nbytes, 1))
+        np.ndarray(maps.shape, dtype=maps.dtype, buffer=shm.buf)[:] = maps
+        # submit_layer holds one reference until all the chunks are submitted
+        self.shms[shm.name] = [shm, 1]
+        for start in range(0, len(unit_ids), self.chunk_size):
+            while len(self.pending) >= self.max_pending:
+                self._wait_oldest()
+            end = min(start + self.chunk_size, len(unit_ids))
+            future = self.executor.submit(_render_units, shm.name, maps.shape, maps.dtype, output_folder,
+                                          layer, start, unit_ids[start:end], paths[start:end], thumbnails,
+                                          rf_banks[start:end])
+            self.shms[shm.name][1] += 1
+            self.pending.append((future, shm.name))
+        self._release(shm.name)
+
+    def _release(self, shm_name):
+        # the shared memory of a layer goes away with its last chunk
+        self.shms[shm_name][1] -= 1
+        if self.shms[shm_name][1] == 0:
+            shm = self.shms.pop(shm_name)[0]
+            shm.close()
+            shm.unlink()
+
+    def _wait_oldest(self):
+        future, shm_name = self.pending.popleft()
+        try:
+            self.num_done += future.result()
+        finally:
+            self._release(shm_name)
+
+    def close(self):
+        try:
+            while self.pending:
+                self._wait_oldest()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+            for shm, _ in self.shms.values():
+                shm.close()
+                shm.unlink()
+            self.shms = {}
@@ -0,0 +1,124 @@
+# pipelined executor for the forward passes
+# the batches come from the DataLoader workers, the main thread runs the
+# forward pass and starts non-blocking copies of the hooked features into
+# pinned host buffers, and a writer thread waits for the copies and persists
+# the results while the next batch is already in the forward pass. The
+# queue between the two is bounded, so a slow writer holds back the forward
+# pass instead of piling up results in memory.
+# At the end the busy time of every stage is reported, to see whether the
+# decoding (load), the forward pass (compute) or the writing (write) is the
+# bottleneck, 'queue' is the time the forward pass waited on a full queue.
+
+import time
+import queue
+import threading
+import torch
+
+import engine
+
+
+class StageTimer(object):
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.busy = dict((stage, 0.0) for stage in stages)
+        self.start = time.time()
+
+    def add(self, stage, seconds):
+        self.busy[stage] += seconds
+
+    def report(self):
+        total = time.time() - self.start
+        print('pipeline %.1fs: ' % total + ', '.join(
+            '%s %.1fs (%.0f%%)' % (stage, self.busy[stage], 100.0 * self.busy[stage] / max(total, 1e-9))
+            for stage in self.stages))
+
+
+class PipelinedExecutor(object):
+    """Run model over batches and hand the captured features to a writer thread.
+
+    capture() is called right after each forward pass and returns the list
+    of hooked tensors of that batch, still on the device. write(info, features)
+    runs in the writer thread with the host copies as numpy arrays, info is
+    whatever came with the batch from the loader.
+    """
+
+    def __init__(self, model, device, channels_last=True, queue_size=4):
+        self.model = model
+        self.device = device
+        self.channels_last = channels_last
+        self.queue_size = queue_size
+        # pinned buffers are reused round robin, a slot is only written again
+        # after the writer is done with it: queue_size queued + 1 writing + 1 filling
+        self.num_slots = queue_size + 2
+        self.buffers = [None] * self.num_slots
+        self.timer = None
+
+    def _to_host(self, slot, features):
+        if self.device.type != 'cuda':
+            return features, None
+        if self.buffers[slot] is None or len(self.buffers[slot]) != len(features) or any(
+                buf.shape[1:] != feat.shape[1:] or buf.shape[0] < feat.shape[0] or buf.dtype != feat.dtype
+                for buf, feat in zip(self.buffers[slot], features)):
+            self.buffers[slot] = [torch.empty(feat.shape, dtype=feat.dtype, pin_memory=True) for feat in features]
+        host = []
+        for buf, feat in zip(self.buffers[slot], features):
+            buf = buf[:feat.shape[0]]
+            buf.copy_(feat, non_blocking=True)
+            host.append(buf)
+        event = torch.cuda.Event()
+        event.record()
+        return host, event
+
+    def _writer(self, tasks, write, errors):
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            if errors:
+                # keep draining so the main thread never blocks on a full queue
+                continue
+            info, host, event = task
+            start = time.time()
+            try:
+                if event is not None:
+                    event.synchronize()
+                write(info, [feat.numpy() for feat in host])
+            except Exception as e:
+                errors.append(e)
+            self.timer.add('write', time.time() - start)
+
+    def run(self, batches, capture, write):
+        """batches yields (input, info), e.g. a DataLoader of (images, paths)."""
+        self.timer = StageTimer(['load', 'compute', 'queue', 'write'])
+        tasks = queue.Queue(maxsize=self.queue_size)
+        errors = []
+        writer = threading.Thread(target=self._writer, args=(tasks, write, errors))
+        writer.daemon = True
+        writer.start()
+        try:
+            batches = iter(batches)
+            slot = 0
+            while not errors:
+                start = time.time()
+                try:
+                    input, info = next(batches)
+                except StopIteration:
+                    break
+                self.timer.add('load', time.time() - start)
+
+                start = time.time()
+                engine.forward(self.model, input, self.device, self.channels_last)
+                host, event = self._to_host(slot, capture())
+                self.timer.add('compute', time.time() - start)
+
+                start = time.time()
+                tasks.put((info, host, event))
+                self.timer.add('queue', time.time() - start)
+                slot = (slot + 1) % self.num_slots
+        finally:
+            tasks.put(None)
+            writer.join()
+        if errors:
+            raise errors[0]
+        self.timer.report()
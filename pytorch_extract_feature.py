@@ -7,18 +7,19 @@
 ##################################################
 
 import torch
-from torch.autograd import Variable as V
-import torchvision.models as models
 from torchvision import transforms as trn
-from torch.nn import functional as F
 import os
-import pdb
+import sys
+import argparse
 import numpy as np
-from scipy.misc import imresize as imresize
-import cv2
-from PIL import Image
 from dataset import Dataset
+from featurestore import FeatureWriter, load_features, load_meta, encode, decode, print_precision_report
+from featurestore import shard_range, shard_root, merge_shards
 import torch.utils.data as data
+import engine
+import pipeline
+from actcache import ActivationCache, model_digest, contiguous_runs
+from modelcache import load_model
 
 # image datasest to be processed
 name_dataset = 'sun+imagenetval'
@@ -28,81 +29,150 @@ with open(os.path.join(root_image, 'imagelist.txt')) as f:
     
 imglist = [os.path.join(root_image, line.rstrip()) for line in lines]
 
-
-# load the pre-trained weights
+# the image list can be split over several processes or machines:
+#   python pytorch_extract_feature.py --shard 0/4   (... --shard 3/4)
+#   python pytorch_extract_feature.py --merge 4
+parser = argparse.ArgumentParser()
+parser.add_argument('--shard', default=None, help='i/N, only extract the i-th of N slices of the image list')
+parser.add_argument('--merge', type=int, default=0, help='N, merge the features of the N finished shards')
+engine.add_engine_args(parser)
+parser.add_argument('--benchmark', action='store_true', help='report images/sec for several thread counts on one batch and exit')
+args = parser.parse_args()
+
+# the pre-trained weights are loaded by modelcache.load_model
 name_model = 'wideresnet_places365'
-model_file = 'whole_wideresnet18_places365.pth.tar'
 
-if not os.access(model_file, os.W_OK):
-    os.system('wget http://places2.csail.mit.edu/models_places365/' + model_file)
-    os.system('wget https://raw.githubusercontent.com/csailvision/places365/master/wideresnet.py')
-        
-model = torch.load(model_file)
-model.eval()
-model.cuda()
+save_name = name_dataset  + '_' + name_model
+if args.merge > 0:
+    merge_shards(save_name, args.merge)
+    print('merged %d shards into %s' % (args.merge, save_name))
+    sys.exit()
+if args.shard is not None:
+    start_idx, end_idx = shard_range(len(imglist), args.shard)
+    imglist = imglist[start_idx:end_idx]
+    save_name = shard_root(save_name, args.shard)
+
+# dataset setup
+img_size = (224, 224) # input image size
+batch_size = 64
+num_workers = 6
+
+# converted from the released checkpoint on the first run, see modelcache.py
+model, device, num_threads, worker_cores = engine.setup_engine(args, load_model(), num_workers)
 
+# layers are named by their dotted path in the model, nested blocks work too,
+# e.g. 'layer3.1.conv2', and all of them are captured in the same forward pass
 features_names = ['avgpool']
 #features_names = ['layer4','avgpool'] # this is the last conv layer and global average pooling layers
 
+# storage dtype of each layer: 'float32' (default), 'float16' or 'bfloat16'
+features_dtypes = {'avgpool': 'float32'}
+report_precision = 1 # print the error of float16/bfloat16 on the first batch of the float32 layers
+# spatial reduction of each layer before it leaves the device:
+# None (full map), 'max', 'mean', 'topk:k' or 'argmax', see engine.reduce_feature
+features_reductions = {}
 
+# activations computed by an earlier run on the same images, with the same
+# weights, layer, reduction and transform, are read from a cache instead
+activation_cache = 'cache_activations'  # '' forwards all the images
+activation_cache_bytes = 8 * 2**30      # least recently used activations beyond it are dropped
+activation_cache_key = 'path'           # 'path' (path, mtime and size) or 'content' (SHA-1 of the file)
 
-features_blobs = []
-def hook_feature(module, input, output):
-    # hook the feature extractor
-    features_blobs.append(np.squeeze(output.data.cpu().numpy()))
 
-for name in features_names:
-    model._modules.get(name).register_forward_hook(hook_feature)
+# hook the feature extractor, the features are reduced and cast to their
+# storage dtype on the device, the copy to the host is done by the pipeline
+features_capture = engine.FeatureCapture(model, features_names, features_reductions, features_dtypes)
 
-# dataset setup
-img_size = (224, 224) # input image size
-batch_size = 64
-num_workers = 6
+# only run the network up to the deepest layer in features_names
+truncate_forward = 1
+if truncate_forward == 1:
+    early_exit = engine.EarlyExit(features_capture.modules)
 
 # image transformer
 tf = trn.Compose([
-        trn.Scale(img_size),
+        trn.Resize(img_size),
         trn.ToTensor(),
         trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
 dataset = Dataset(imglist, tf)
 
+if args.benchmark:
+    input = torch.stack([dataset[i][0] for i in range(min(batch_size, len(dataset)))])
+    configs = [(n, c) for n in sorted(set([1, 2, 4, 8, 16, 32, 64, num_threads])) if n <= num_threads for c in (0, 1)]
+    engine.benchmark(model, input, device, configs)
+    sys.exit()
+
+# save variables, the features are streamed to disk batch by batch
+# and a rerun continues from the first batch which is not on disk yet
+resume = 1
+checkpoint_every = 50 # batches between two updates of the progress manifest
+writer = FeatureWriter(save_name, features_names, len(dataset), features_dtypes, resume=resume)
+batches = [list(range(start_idx, end_idx)) for start_idx, end_idx in writer.todo(batch_size)]
+
+def write_rows(indices, features):
+    # the rows of the sorted image ids indices, a write per run of consecutive ids
+    features = [encode(feat, dtype) for feat, dtype in zip(features, writer.features_dtypes)]
+    for start, end in contiguous_runs(indices):
+        writer.write(int(indices[start]), [feat[start:end] for feat in features])
+
+cache = None
+if activation_cache:
+    cache = ActivationCache(activation_cache, model_digest(model), repr(tf), activation_cache_bytes, activation_cache_key)
+    # the cached images are written right away, only the others go through the network
+    indices_todo = []
+    for indices in batches:
+        features, found = cache.lookup([imglist[i] for i in indices], features_names, features_reductions)
+        indices = np.array(indices)
+        if found.any():
+            write_rows(indices[found], [feat[found] for feat in features])
+        indices_todo += indices[~found].tolist()
+    writer.checkpoint()
+    batches = [indices_todo[i:i+batch_size] for i in range(0, len(indices_todo), batch_size)]
+    print('%d images in the activation cache, %d to forward' % (cache.hits, len(indices_todo)))
+
 loader = data.DataLoader(
         dataset,
-        batch_size=batch_size,
+        batch_sampler=batches,
         num_workers=num_workers,
-        shuffle=False)
-
-# save variables
-imglist_results = []
-features_results = [None] * len(features_names)
-num_batches = len(dataset) / batch_size
-for batch_idx, (input, paths) in enumerate(loader):
-    del features_blobs[:]
-    print '%d / %d' % (batch_idx, num_batches)
-    input = input.cuda()
-    input_var = V(input, volatile=True)
-    logit = model.forward(input_var)
-    imglist_results = imglist_results + list(paths)
-    if features_results[0] is None:
-        # initialize the feature variable
-        for i, feat_batch in enumerate(features_blobs):
-            size_features = ()
-            size_features = size_features + (len(dataset),)
-            size_features = size_features + feat_batch.shape[1:]
-            features_results[i] = np.zeros(size_features)
-            print features_results[i].shape
-    start_idx = batch_idx*batch_size
-    end_idx = min((batch_idx+1)*batch_size, len(dataset))
-    for i, feat_batch in enumerate(features_blobs):
-        features_results[i][start_idx:end_idx] = feat_batch
-
-# save the features
-save_name = name_dataset  + '_' + name_model
-np.savez('%s.npz'%save_name, features=features_results, imglist=imglist, features_names=features_names)
+        pin_memory=device.type == 'cuda',
+        worker_init_fn=engine.pin_workers(worker_cores))
+
+def write_batch(info, features):
+    # runs in the writer thread while the next batch is in the forward pass
+    batch_idx, indices, paths = info
+    print('%d / %d' % (batch_idx, num_batches))
+    if report_precision == 1 and batch_idx == 0:
+        for name, feat in zip(features_names, features):
+            if feat.dtype == np.float32:
+                print_precision_report(name, feat)
+    write_rows(indices, features)
+    if cache is not None:
+        cache.put(paths, features_names, [decode(feat, dtype) for feat, dtype in zip(features, writer.features_dtypes)],
+                  features_reductions)
+    throughput.update(len(paths))
+    if (batch_idx+1) % checkpoint_every == 0:
+        writer.checkpoint()
+
+def batches_info():
+    for batch_idx, (indices, (input, paths)) in enumerate(zip(batches, loader)):
+        yield input, (batch_idx, indices, paths)
+
+throughput = engine.Throughput(engine.describe(device, args.channels_last))
+num_batches = len(batches)
+executor = pipeline.PipelinedExecutor(model, device, args.channels_last)
+executor.run(batches_info(), features_capture.pop, write_batch)
+throughput.report()
+
+# save the image list and the layer names next to the features
+writer.close(imglist)
+if cache is not None:
+    cache.save()
+    cache.report()
 
 save_matlab = 0
 if save_matlab == 1:
     import scipy.io
-    scipy.io.savemat('%s.mat'%save_name, mdict={'list': imglist_results, 'features': features_results[0]})
+    features_results, _, _ = load_features(save_name)
+    features_dtype = load_meta(save_name)['features_dtypes'][0]
+    scipy.io.savemat('%s.mat'%save_name, mdict={'list': imglist, 'features': decode(features_results[0], features_dtype)})
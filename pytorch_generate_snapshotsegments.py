@@ -0,0 +1,167 @@
+# the unit segmentation of a series of training snapshots using pyTorch
+# pytorch_generate_unitsegments.py visualizes one model, running it for every
+# snapshot decodes the whole image list once per snapshot. Here every batch is
+# decoded and preprocessed once and goes through all the snapshots in turn
+# (engine.ModelSeries), each snapshot has its own top-k of every unit, so the
+# image I/O of a sweep is the one of a single model. The top images of all the
+# snapshots are decoded once more for the montages, through the thumbnail cache.
+# The drift of the units from one snapshot to the next, the overlap of their
+# top-k images, is saved as well.
+#   python pytorch_generate_snapshotsegments.py
+#   python pytorch_generate_snapshotsegments.py --checkpoints a.pth.tar,b.pth.tar
+
+import os
+import argparse
+import numpy as np
+import torch
+from torchvision import transforms as trn
+import torch.utils.data as data
+from dataset import Dataset
+from modelcache import load_model, converted_filename
+import engine
+import pipeline
+import montage
+from thumbcache import ThumbnailCache
+from unittopk import UnitTopK
+
+# visualization setup, the same as pytorch_generate_unitsegments.py
+img_size = (224, 224)       # input image size
+segment_size = (120,120)    # the unit segmentaiton size
+num_top = 12                # how many top activated images to extract
+margin = 3                  # pixels between two segments
+threshold_scale = 0.2       # the scale used to segment the feature map. Smaller the segmentation will be tighter.
+flag_crop = 0               # whether to generate tight crop for the unit visualiation.
+
+# dataset setup
+batch_size = 64
+num_workers = 6
+thumbnail_cache = 'cache_thumbnails'  # '' decodes the top images for every montage
+thumbnail_capacity = 100000
+
+# the snapshots of the training run, in training order (see tightcrop.process_snapshot_iterations)
+basename = 'places'
+iterations = [1,2,4,9,20,44,99,223,492,1108,2446,5509,12164,27396,60491,136238,300818,600818,1200818,2400818]
+checkpoint_template = 'snapshots/{basename}_iter_{iteration}.pth.tar'
+features_names = ['layer4']
+
+# image datasest to be processed
+name_dataset = 'sun+imagenetval'
+root_image = 'images'
+with open(os.path.join(root_image, 'imagelist.txt')) as f:
+    lines = f.readlines()
+imglist = [os.path.join(root_image, line.rstrip()) for line in lines]
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--checkpoints', default=None, help='comma separated checkpoint files, the snapshots of checkpoint_template by default')
+engine.add_engine_args(parser)
+args = parser.parse_args()
+
+if args.checkpoints:
+    checkpoints = args.checkpoints.split(',')
+else:
+    checkpoints = [checkpoint_template.format(basename=basename, iteration=iteration) for iteration in iterations]
+# a checkpoint converted by modelcache.py is enough without the original
+missing = [filename for filename in checkpoints
+           if not os.path.exists(filename) and not os.path.exists(converted_filename(filename))]
+if missing:
+    raise FileNotFoundError('no checkpoint ' + ', '.join(missing))
+# the name of a snapshot is its file name, e.g. places_iter_492
+snapshot_names = [os.path.basename(filename).split('.pth')[0] for filename in checkpoints]
+
+# load the snapshots, each is converted from its checkpoint on the first run
+models = [load_model(filename) for filename in checkpoints]
+series, device, num_threads, worker_cores = engine.setup_engine(args, engine.ModelSeries(models), num_workers)
+
+# hook the layers of every snapshot, layer j of snapshot i is the feature i * len(features_names) + j,
+# then every snapshot stops after its deepest layer and the next one gets the batch
+features_capture = engine.FeatureCapture(series, ['models.%d.%s' % (i, layer)
+                                                  for i in range(len(models)) for layer in features_names])
+early_exits = [engine.EarlyExit([engine.get_module(model, layer) for layer in features_names]) for model in series.models]
+executor = pipeline.PipelinedExecutor(series, device, args.channels_last)
+
+# image transformer
+tf = trn.Compose([
+        trn.Resize(img_size),
+        trn.ToTensor(),
+        trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+])
+
+# the top images of the units of all the snapshots go in the thumbnail cache during the scan
+thumbnails = ThumbnailCache(thumbnail_cache, segment_size, thumbnail_capacity) if thumbnail_cache else None
+trackers = [[UnitTopK(num_top) for layer in features_names] for model in models]
+trackers_all = [tracker for trackers_snapshot in trackers for tracker in trackers_snapshot]
+
+def capture_scan():
+    # the top-k of every snapshot are updated on the device, only the ranked flags go to the host
+    for tracker, feat in zip(trackers_all, features_capture.pop()):
+        tracker.update(feat)
+    if thumbnails is None:
+        return []
+    ids = torch.arange(trackers_all[0].num_seen - feat.shape[0], trackers_all[0].num_seen, device=feat.device)
+    return [torch.stack([tracker.ranked(ids) for tracker in trackers_all]).any(0)]
+
+loader = data.DataLoader(
+        Dataset(imglist, tf, segment_size if thumbnails is not None else None),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        shuffle=False,
+        pin_memory=device.type == 'cuda',
+        worker_init_fn=engine.pin_workers(worker_cores))
+
+throughput = engine.Throughput(engine.describe(device, args.channels_last) + ' x%d snapshots' % len(models))
+def write_scan(info, features):
+    batch_idx, paths, thumbs = info
+    print('%d / %d' % (batch_idx+1, len(loader)))
+    if thumbnails is not None:
+        for i in np.nonzero(features[0])[0]:
+            thumbnails.put(paths[i], thumbs[i].numpy())
+    throughput.update(len(paths))
+executor.run(((batch[0], (batch_idx, batch[1], batch[2] if thumbnails is not None else None))
+              for batch_idx, batch in enumerate(loader)), capture_scan, write_scan)
+throughput.report()
+
+# the drift of every unit between two consecutive snapshots, the fraction of its
+# top-k images which are still in its top-k, one csv per layer with a column per step
+output_root = 'result_segments'
+results = [[tracker.numpy() for tracker in trackers_snapshot] for trackers_snapshot in trackers]
+for layerID, layer in enumerate(features_names):
+    steps = []
+    for i in range(1, len(models)):
+        indices_a = results[i-1][layerID][1]
+        indices_b = results[i][layerID][1]
+        overlap = (indices_a[:, :, np.newaxis] == indices_b[:, np.newaxis, :]).any(2).sum(1) / float(indices_a.shape[1])
+        steps.append(overlap)
+        print('%s %s -> %s: mean top-%d overlap %.3f' % (layer, snapshot_names[i-1], snapshot_names[i],
+                                                         num_top, overlap.mean()))
+    if steps:
+        if not os.path.exists(output_root):
+            os.makedirs(output_root)
+        with open(os.path.join(output_root, 'drift_%s_%s.csv' % (name_dataset, layer)), 'w') as f:
+            f.write(','.join(['unit'] + ['%s->%s' % (snapshot_names[i-1], snapshot_names[i])
+                                         for i in range(1, len(models))]) + '\n')
+            for unitID in range(len(steps[0])):
+                f.write(','.join(['%d' % unitID] + ['%.4f' % overlap[unitID] for overlap in steps]) + '\n')
+
+# the html and montages of every snapshot, all the snapshots share the render pool
+num_render_workers = 4      # 0 renders in the main process
+render_pool = montage.RenderPool(num_render_workers, segment_size, threshold_scale, margin, flag_crop,
+                                 thumbnails=thumbnails)
+for snapshotID, snapshot_name in enumerate(snapshot_names):
+    output_folder = os.path.join(output_root, snapshot_name)
+    if not os.path.exists(output_folder):
+        os.makedirs(os.path.join(output_folder, 'image'))
+    for layerID, layer in enumerate(features_names):
+        scores, indices, maps = results[snapshotID][layerID]
+        suffixes = ['', '_crop'] if flag_crop == 1 else ['']
+        for suffix in suffixes:
+            with open(os.path.join(output_folder, layer + suffix + '.html'), 'w') as f:
+                f.write('\n<br>'.join(['unit%03d<br><img src="image/%s-unit%03d%s.jpg">' % (unitID, layer, unitID, suffix)
+                                       for unitID in range(len(indices))]))
+        render_pool.submit_layer(output_folder, layer, maps,
+                                 [[imglist[item] for item in indices_unit] for indices_unit in indices])
+render_pool.close()
+print('%d units rendered' % render_pool.num_done)
+if thumbnails is not None:
+    thumbnails.save()
+    thumbnails.report()
+print('done check results in ' + output_root)
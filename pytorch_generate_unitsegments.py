@@ -7,17 +7,25 @@
 ##################################################
 
 import torch
-from torch.autograd import Variable as V
-import torchvision.models as models
 from torchvision import transforms as trn
-from torch.nn import functional as F
 import os
+import sys
+from collections import deque
+import argparse
 import numpy as np
-import cv2
-from PIL import Image
 from dataset import Dataset
+from featurestore import STORAGE_DTYPES, encode, decode, print_precision_report
+from featurestore import FeatureWriter, load_features, shard_range, shard_root, merge_shards
+from unitmax import save_unitmax, load_unitmax, remove_stale_unitmax
+from actcache import ActivationCache, model_digest
+from modelcache import load_model
 import torch.utils.data as data
-import torchvision.models as models
+import engine
+import pipeline
+import montage
+from thumbcache import ThumbnailCache
+from unittopk import UnitTopK, RescoreTopK, top_indices, union_ids
+from unittopk import save_topk, load_topk, changed_units
 
 # visualization setup
 img_size = (224, 224)       # input image size
@@ -27,58 +35,38 @@ margin = 3                  # pixels between two segments
 threshold_scale = 0.2       # the scale used to segment the feature map. Smaller the segmentation will be tighter.
 flag_crop = 0               # whether to generate tight crop for the unit visualiation.
 flag_classspecific = 1      # whether to generate the class specific unit for each category (only works for network with global average pooling at the end)
+# segment with the synthetic receptive field of the units (see rfsegment.py) instead of
+# upsampling the feature maps, the masks of a layer are built once and kept in rf_cache.
+# The receptive field grows with depth, so the size is given per layer, e.g.
+# {'layer3': 100, 'layer4': 'empirical'}, a layer which is not in it is upsampled.
+# With 'empirical' the size of every unit is estimated by occlusion of its top images
+# (see empiricalrf.py), once per model, layer and unit.
+rf_size = {}                # layer -> diameter of the receptive field in input pixels, 'empirical' or 0 upsamples the feature maps
+rf_threshold = 0.5          # the positions above rf_threshold * the max of the map are segmented
+rf_cache = 'cache_rf'
 
 # dataset setup
 batch_size = 64
 num_workers = 6
 
+# the top images resized to segment_size are kept in a memory-mapped cache,
+# they are decoded once for all the layers and the following runs
+thumbnail_cache = 'cache_thumbnails'  # '' decodes the top images for every montage
+thumbnail_capacity = 100000           # least recently used thumbnails beyond it are dropped
 
-"""
-using old version of pytorch to load new torch models
-"""
- # hacky way to deal with the Pytorch 1.0 update
-def recursion_change_bn(module):
-    if isinstance(module, torch.nn.BatchNorm2d):
-        module.track_running_stats = 1
-    else:
-        for i, (name, module1) in enumerate(module._modules.items()):
-            module1 = recursion_change_bn(module1)
-    return module
-
-def load_model():
-    # this model has a last conv feature map as 14x14
-
-    model_file = 'wideresnet18_places365.pth.tar'
-    if not os.access(model_file, os.W_OK):
-        os.system('wget http://places2.csail.mit.edu/models_places365/' + model_file)
-        os.system('wget https://raw.githubusercontent.com/csailvision/places365/master/wideresnet.py')
-
-    import wideresnet
-    model = wideresnet.resnet18(num_classes=365)
-    checkpoint = torch.load(model_file, map_location=lambda storage, loc: storage)
-    state_dict = {str.replace(k,'module.',''): v for k,v in checkpoint['state_dict'].items()}
-    model.load_state_dict(state_dict)
-    # hacky way to deal with the upgraded batchnorm2D and avgpool layers...
-    for i, (name, module) in enumerate(model._modules.items()):
-        module = recursion_change_bn(model)
-    model.avgpool = torch.nn.AvgPool2d(kernel_size=14, stride=1, padding=0)
-    model.eval()
-    model.cuda()
-    return model
-
-import torch._utils
-try:
-    torch._utils._rebuild_tensor_v2
-except AttributeError:
-    def _rebuild_tensor_v2(storage, storage_offset, size, stride, requires_grad, backward_hooks):
-        tensor = torch._utils._rebuild_tensor(storage, storage_offset, size, stride)
-        tensor.requires_grad = requires_grad
-        tensor._backward_hooks = backward_hooks
-        return tensor
-    torch._utils._rebuild_tensor_v2 = _rebuild_tensor_v2
-
-
-# load model
+# activations computed by an earlier run on the same images, with the same
+# weights, layer and transform, are read from a cache instead. Only the max
+# of every unit is cached by default: the single pass then forwards again the
+# cached images which are in the top-k of some unit among the cached ones, to
+# get their maps. With activation_cache_maps the single pass caches the full
+# feature maps (about 400 KB per image for layer4) and forwards none of them.
+activation_cache = 'cache_activations'  # '' forwards all the images
+activation_cache_bytes = 8 * 2**30      # least recently used activations beyond it are dropped
+activation_cache_key = 'path'           # 'path' (path, mtime and size) or 'content' (SHA-1 of the file)
+activation_cache_maps = 0               # 1 caches the full feature maps in the single pass
+
+
+# load model, converted from the released checkpoint on the first run
 model = load_model()
 print(model)
 model_name = 'wideresnet_places365'
@@ -98,8 +86,13 @@ with open(class_file) as f:
     for line in f:
             classes.append(line.strip().split(' ')[0][3:])
 classes = tuple(classes)
-# feature extraction layer setup
+# feature extraction layer setup, layers are named by their dotted path in the model.
+# All the layers are visualized from one scan of the dataset, e.g.
+# ['layer1', 'layer2', 'layer3', 'layer4'], the last one is used for the class specific units
 features_names = ['layer4']
+# storage dtype of each layer: 'float32' (default), 'float16' or 'bfloat16'
+features_dtypes = {'layer4': 'float32'}
+report_precision = 1 # print the error of float16/bfloat16 on the first batch of the float32 layers
 
 
 # image datasest to be processed
@@ -109,48 +102,231 @@ with open(os.path.join(root_image, 'imagelist.txt')) as f:
     lines = f.readlines()
 imglist = [os.path.join(root_image, line.rstrip()) for line in lines]
 
-features_blobs = []
-def hook_feature(module, input, output):
-    # hook the feature extractor
-    features_blobs.append(np.squeeze(output.data.cpu().numpy()))
-
-for name in features_names:
-    model._modules.get(name).register_forward_hook(hook_feature)
+# the scan for the max activations can be split over several processes or machines:
+#   python pytorch_generate_unitsegments.py --shard 0/4   (... --shard 3/4)
+#   python pytorch_generate_unitsegments.py --merge 4     (merges and renders the units)
+parser = argparse.ArgumentParser()
+parser.add_argument('--shard', default=None, help='i/N, only scan the i-th of N slices of the image list')
+parser.add_argument('--merge', type=int, default=0, help='N, merge the max activations of the N finished shards')
+engine.add_engine_args(parser)
+args = parser.parse_args()
+
+# put the model on the device, the CPU thread pools are sized around the loader workers
+model, device, num_threads, worker_cores = engine.setup_engine(args, model, num_workers)
+maxfeatures_root = 'maxfeatures_%s_%s' % (name_dataset, model_name)
+
+# keep the top images of every unit and their feature maps during the scan,
+# so the montages are rendered without forwarding the top images a second time.
+# The shards only save their max activations, after --merge the top images are
+# forwarded again.
+single_pass = 1
+single_pass = single_pass == 1 and args.shard is None and args.merge == 0
+
+# hook the feature extractor, the copy to the host is done by the pipeline.
+# The scan only needs the max over space of every unit, it is taken and cast to
+# the storage dtype on the device before the copy to the host. The single pass
+# keeps the float32 maps for the top-k.
+features_capture = engine.FeatureCapture(model, features_names,
+                                         dict.fromkeys(features_names, None if single_pass else 'max'),
+                                         None if single_pass else features_dtypes)
+executor = pipeline.PipelinedExecutor(model, device, args.channels_last)
+
+# only run the network up to the deepest layer in features_names
+truncate_forward = 1
+if truncate_forward == 1:
+    early_exit = engine.EarlyExit(features_capture.modules)
 
 # image transformer
 tf = trn.Compose([
-        trn.Scale(img_size),
+        trn.Resize(img_size),
         trn.ToTensor(),
         trn.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
 ])
 
-dataset = Dataset(imglist, tf)
-loader = data.DataLoader(
-        dataset,
-        batch_size=batch_size,
-        num_workers=num_workers,
-        shuffle=False)
+imglist_scan = imglist
+if args.shard is not None:
+    start_idx, end_idx = shard_range(len(imglist), args.shard)
+    imglist_scan = imglist[start_idx:end_idx]
+
+thumbnails = ThumbnailCache(thumbnail_cache, segment_size, thumbnail_capacity) if thumbnail_cache else None
+# the loader workers decode the images of the scan anyway, the ones in the top
+# of some unit so far go in the thumbnail cache on the way
+warm_thumbnails = single_pass and thumbnails is not None
+
+# the top-k of every unit is saved after the scan. When images are added to the
+# image list, the next run only forwards the new ones on top of the saved top-k
+# and only renders again the units whose top images have changed.
+incremental = 1
+topk_root = 'topk_%s_%s' % (name_dataset, model_name)
+trackers = [UnitTopK(num_top) for name in features_names]
+imglist_topk = imglist_scan     # the images the ids in the top-k refer to
+indices_before = None
+weights_digest = model_digest(model)  # the saved top-k and the activation cache are for these weights
+saved = load_topk(topk_root, features_names, num_top, weights_digest, repr(tf)) if incremental == 1 and single_pass else None
+if saved is not None:
+    imglist_saved, states = saved
+    if set(imglist_saved).issubset(imglist):
+        known = set(imglist_saved)
+        imglist_scan = [path for path in imglist if path not in known]
+        imglist_topk = imglist_saved + imglist_scan
+        trackers = [UnitTopK(num_top, offset=len(imglist_saved)) for name in features_names]
+        for tracker, (scores, indices, maps) in zip(trackers, states):
+            tracker.load(scores, indices, maps, device)
+        indices_before = [indices for scores, indices, maps in states]
+        print('%d images in the saved top-k, %d new images to scan' % (len(imglist_saved), len(imglist_scan)))
+    else:
+        print('images were removed from the image list since the saved top-k, scan all of them again')
+
+# the N x units max activations of every layer on the whole image list are
+# saved in unitMax_<model>.h5, which generate_unitsegments.m reads as well. A
+# later run with the same model weights, preprocessing and image list skips the scan
+# and only forwards the top images of the units.
+unitmax_file = 'unitMax_%s.h5' % model_name
+maxfeatures_cached = None
+if args.shard is None and args.merge == 0 and indices_before is None:
+    maxfeatures_cached = load_unitmax(unitmax_file, features_names, imglist, model_name, weights_digest, repr(tf))
+    if maxfeatures_cached is not None:
+        single_pass = False
+
+# what the activation cache keeps of the layers, the single pass only caches the max without activation_cache_maps
+cache_maps = single_pass and activation_cache_maps == 1
+cache_reductions = features_capture.reductions if cache_maps or not single_pass else dict.fromkeys(features_names, 'max')
+
+scan_ids = deque()   # ids of the batches going through the forward pass, in order
+def capture_scan():
+    # runs right after the forward pass, the top-k are updated on the device
+    features = features_capture.pop()
+    ids = scan_ids.popleft()
+    outputs = features
+    if single_pass:
+        outputs = [tracker.update(feat, ids) for tracker, feat in zip(trackers, features)]
+        if cache is not None and cache_maps:
+            # the full maps go in the activation cache
+            outputs += features
+    if warm_thumbnails:
+        outputs.append(torch.stack([tracker.ranked(ids) for tracker in trackers]).any(0))
+    return outputs
 
 # extract the max value activaiton for each image
 imglist_results = []
-maxfeatures = [None] * len(features_names)
-num_batches = len(dataset) / batch_size
-for batch_idx, (input, paths) in enumerate(loader):
-    del features_blobs[:]
-    print('%d / %d' % (batch_idx+1, num_batches))
-    input = input.cuda()
-    input_var = V(input, volatile=True)
-    logit = model.forward(input_var)
-    imglist_results = imglist_results + list(paths)
-    if maxfeatures[0] is None:
-        # initialize the feature variable
-        for i, feat_batch in enumerate(features_blobs):
-            size_features = (len(dataset), feat_batch.shape[1])
-            maxfeatures[i] = np.zeros(size_features)
-    start_idx = batch_idx*batch_size
-    end_idx = min((batch_idx+1)*batch_size, len(dataset))
-    for i, feat_batch in enumerate(features_blobs):
-        maxfeatures[i][start_idx:end_idx] = np.max(np.max(feat_batch,3),2)
+cache = None
+if args.merge > 0:
+    # the shards have done the scan, put their max activations back together in the list order
+    # the rows of the shards must be the images of the current list
+    maxfeatures, imglist_results, _ = load_features(merge_shards(maxfeatures_root, args.merge, imglist=imglist,
+                                                                 features_names=features_names))
+elif maxfeatures_cached is not None:
+    print('the max activations are loaded from ' + unitmax_file)
+    maxfeatures = [encode(feat, features_dtypes.get(name, 'float32')) for name, feat in zip(features_names, maxfeatures_cached)]
+    imglist_results = imglist
+elif len(imglist_scan) == 0:
+    print('no new images, the saved top-k is up to date')
+else:
+    dataset = Dataset(imglist_scan, tf, segment_size if warm_thumbnails else None)
+    batches = [list(range(start_idx, min(start_idx + batch_size, len(dataset))))
+               for start_idx in range(0, len(dataset), batch_size)]
+    offset = len(imglist_topk) - len(imglist_scan)   # id in the top-k of the first image of the scan
+
+    maxfeatures = [None] * len(features_names)
+    def store_max(indices, features):
+        # the rows indices of the max activations
+        if maxfeatures[0] is None:
+            # initialize the feature variable
+            for i, feat_batch in enumerate(features):
+                size_features = (len(dataset), feat_batch.shape[1])
+                dtype = features_dtypes.get(features_names[i], 'float32')
+                maxfeatures[i] = np.zeros(size_features, dtype=STORAGE_DTYPES[dtype])
+                if report_precision == 1 and feat_batch.dtype == np.float32:
+                    print_precision_report(features_names[i], feat_batch)
+        for i, feat_batch in enumerate(features):
+            maxfeatures[i][indices] = encode(feat_batch, features_dtypes.get(features_names[i], 'float32'))
+
+    if activation_cache:
+        cache = ActivationCache(activation_cache, weights_digest, repr(tf), activation_cache_bytes, activation_cache_key)
+        # the images in the cache go in the top-k right away, only the others are forwarded
+        indices_todo = []
+        indices_cached = []
+        for indices in batches:
+            features, found = cache.lookup([imglist_scan[i] for i in indices], features_names, cache_reductions)
+            indices = np.array(indices)
+            if found.any():
+                features = [feat[found] for feat in features]
+                if single_pass and cache_maps:
+                    ids = torch.as_tensor(offset + indices[found], device=device)
+                    features = [tracker.update(torch.from_numpy(feat).to(device), ids).cpu().numpy()
+                                for tracker, feat in zip(trackers, features)]
+                store_max(indices[found], features)
+                indices_cached += indices[found].tolist()
+            indices_todo += indices[~found].tolist()
+        if single_pass and not cache_maps and indices_cached:
+            # only the max of the cached images is known, the ones in the top-k of some unit
+            # among them can end up in the final top-k and are forwarded again for their maps
+            indices_cached = np.array(indices_cached)
+            top_cached = union_ids([top_indices(maxfeatures[i][indices_cached], num_top, features_dtypes.get(name, 'float32'))
+                                    for i, name in enumerate(features_names)])
+            indices_todo = sorted(indices_todo + indices_cached[top_cached].tolist())
+        batches = [indices_todo[i:i+batch_size] for i in range(0, len(indices_todo), batch_size)]
+        print('%d images in the activation cache, %d to forward' % (cache.hits, len(indices_todo)))
+
+    loader = data.DataLoader(
+            dataset,
+            batch_sampler=batches,
+            num_workers=num_workers,
+            pin_memory=device.type == 'cuda',
+            worker_init_fn=engine.pin_workers(worker_cores))
+
+    throughput = engine.Throughput(engine.describe(device, args.channels_last))
+    def write_max(info, features):
+        # runs in the writer thread while the next batch is in the forward pass
+        batch_idx, indices, paths, thumbs = info
+        print('%d / %d' % (batch_idx+1, len(batches)))
+        if warm_thumbnails:
+            ranked = features.pop()
+            for i in np.nonzero(ranked)[0]:
+                thumbnails.put(paths[i], thumbs[i].numpy())
+        if cache is not None:
+            # the full maps of the single pass, or the max activations in their storage dtype
+            cached = features[-len(features_names):]
+            if not single_pass:
+                cached = [decode(feat, features_dtypes.get(name, 'float32')) for name, feat in zip(features_names, cached)]
+            cache.put(paths, features_names, cached, cache_reductions)
+        store_max(indices, features[:len(features_names)])
+        throughput.update(len(paths))
+    def batches_info():
+        for batch_idx, (indices, batch) in enumerate(zip(batches, loader)):
+            scan_ids.append([offset + i for i in indices])
+            yield batch[0], (batch_idx, indices, batch[1], batch[2] if warm_thumbnails else None)
+    executor.run(batches_info(), capture_scan, write_max)
+    throughput.report()
+    imglist_results = imglist_scan
+
+    if args.shard is not None:
+        # save the partial max activations, the units are rendered after --merge
+        writer = FeatureWriter(shard_root(maxfeatures_root, args.shard), features_names, len(dataset), features_dtypes)
+        writer.write(0, maxfeatures)
+        writer.close(imglist_results)
+        if cache is not None:
+            cache.save()
+            cache.report()
+        print('done shard %s, merge all the shards with --merge' % args.shard)
+        sys.exit()
+
+if maxfeatures_cached is None and imglist_results == imglist:
+    # a scan of the whole image list, not only of the images new to the saved top-k
+    save_unitmax(unitmax_file, features_names,
+                 [decode(feat, features_dtypes.get(name, 'float32')) for name, feat in zip(features_names, maxfeatures)],
+                 imglist, model_name, weights_digest, repr(tf))
+elif maxfeatures_cached is None:
+    # an incremental run only has the max activations of the new images, a file
+    # of the image list before them is out of date
+    remove_stale_unitmax(unitmax_file, features_names, imglist, model_name, weights_digest, repr(tf))
+
+if single_pass:
+    if incremental == 1:
+        save_topk(topk_root, features_names, trackers, imglist_topk, weights_digest, repr(tf))
+    num_units_layers = [len(tracker.scores) for tracker in trackers]
+else:
+    num_units_layers = [feat.shape[1] for feat in maxfeatures]
 
 # generate the top activated images
 output_folder = 'result_segments/%s' % model_name
@@ -161,7 +337,7 @@ if not os.path.exists(output_folder):
 for layerID, layer in enumerate(features_names):
     file_html = os.path.join(output_folder, layer + '.html')
     with open(file_html, 'w') as f:
-        num_units = maxfeatures[layerID].shape[1]
+        num_units = num_units_layers[layerID]
         lines_units = ['%s-unit%03d.jpg' % (layer, unitID) for unitID in range(num_units)]
         lines_units = ['unit%03d<br><img src="image/%s">'%(unitID, lines_units[unitID]) for unitID in range(num_units)]
         f.write('\n<br>'.join(lines_units))
@@ -170,7 +346,7 @@ for layerID, layer in enumerate(features_names):
     if flag_crop == 1:
         file_html_crop = os.path.join(output_folder, layer + '_crop.html')
         with open(file_html_crop, 'w') as f:
-            num_units = maxfeatures[layerID].shape[1]
+            num_units = num_units_layers[layerID]
             lines_units = ['%s-unit%03d_crop.jpg' % (layer, unitID) for unitID in range(num_units)]
             lines_units = ['unit%03d<br><img src="image/%s">'%(unitID, lines_units[unitID]) for unitID in range(num_units)]
             f.write('\n<br>'.join(lines_units))
@@ -199,53 +375,83 @@ if flag_classspecific == 1:
 
 
 # generate the unit visualization
-for layerID, layer in enumerate(features_names):
-    num_units = maxfeatures[layerID].shape[1]
-    imglist_sorted = []
-    # load the top actiatied image list into one list
-    for unitID in range(num_units):
-        activations_unit = np.squeeze(maxfeatures[layerID][:, unitID])
-        idx_sorted = np.argsort(activations_unit)[::-1]
-        imglist_sorted += [imglist[item] for item in idx_sorted[:num_top]]
-
-    # data loader for the top activated images
+# the montages are rendered and encoded by a pool of processes, while the
+# main process hands out the units of the next layer
+num_render_workers = 4      # 0 renders in the main process
+render_pool = montage.RenderPool(num_render_workers, segment_size, threshold_scale, margin, flag_crop,
+                                 thumbnails=thumbnails, rf_threshold=rf_threshold)
+
+def rf_bank(layer, maps, indices, imglist_indices):
+    # the file of the receptive field masks of layer at the segment size, or the list of the
+    # files of every unit for the empirical sizes, None to upsample the maps
+    size = rf_size.get(layer, 0)
+    if not size:
+        return None
+    scale = segment_size[0] / float(img_size[0])
+    if size == 'empirical':
+        import empiricalrf
+        # the early exit of the scan would stop the forward pass before the hooks of the estimator
+        if truncate_forward == 1:
+            early_exit.enabled = False
+        estimator = empiricalrf.EmpiricalRF(rf_cache, weights_digest)
+        sizes = estimator.estimate(model, device, layer, Dataset(imglist_indices, tf), indices, args.channels_last)
+        return empiricalrf.rf_banks(rf_cache, layer, sizes, maps.shape[-2:], (segment_size[1], segment_size[0]), scale)
+    import rfsegment
+    return rfsegment.mask_bank_file(rf_cache, layer, maps.shape[-2:], (segment_size[1], segment_size[0]),
+                                    size * scale)
+
+if single_pass:
+    # the top images of every layer and their maps are already known from the scan
+    for layerID, layer in enumerate(features_names):
+        scores, indices, maps = trackers[layerID].numpy()
+        unit_ids = None
+        if indices_before is not None:
+            # the units with new top images, and the ones with no montage yet
+            changed = set(changed_units(indices_before[layerID], indices))
+            unit_ids = [unitID for unitID in range(len(indices)) if unitID in changed or not os.path.exists(
+                os.path.join(output_folder, 'image', '%s-unit%03d.jpg' % (layer, unitID)))]
+            print('%s: %d of %d units changed' % (layer, len(changed), len(indices)))
+        render_pool.submit_layer(output_folder, layer, maps,
+                                 [[imglist_topk[item] for item in indices_unit] for indices_unit in indices], unit_ids,
+                                 rf_bank(layer, maps, indices, imglist_topk))
+else:
+    # forward the top images of all the layers again in one pass, each image
+    # once however many units of however many layers it is in the top of
+    indices_layers = [top_indices(maxfeatures[layerID], num_top, features_dtypes.get(layer, 'float32'))
+                      for layerID, layer in enumerate(features_names)]
+    image_ids = union_ids(indices_layers)
+    rescores = [RescoreTopK(indices, image_ids) for indices in indices_layers]
+    print('%d unique top images for %d units in %d layers' % (
+        len(image_ids), sum(len(indices) for indices in indices_layers), len(features_names)))
+    features_capture.reductions = dict.fromkeys(features_names, None)
+    features_capture.dtypes = {}
     loader_top = data.DataLoader(
-        Dataset(imglist_sorted, tf),
-        batch_size=num_top,
+        Dataset([imglist_results[item] for item in image_ids], tf),
+        batch_size=batch_size,
         num_workers=num_workers,
-        shuffle=False)
-    for unitID, (input, paths) in enumerate(loader_top):
-        del features_blobs[:]
-        print('%d / %d' % (unitID+1, num_units))
-        input = input.cuda()
-        input_var = V(input, volatile=True)
-        logit = model.forward(input_var)
-        feature_maps = features_blobs[layerID]
-
-        images_input = input.cpu().numpy()
-        max_value = 0
-        output_unit = []
-        for i in range(num_top):
-            feature_map = feature_maps[i][unitID]
-            if max_value == 0:
-                max_value = np.max(feature_map)
-            feature_map = feature_map / max_value
-            mask = cv2.resize(feature_map, segment_size)
-            mask[mask < threshold_scale] = 0.0 # binarize the mask
-            mask[mask > threshold_scale] = 1.0
-
-            img = cv2.imread(paths[i])
-            img = cv2.resize(img, segment_size)
-            img = cv2.normalize(img.astype('float'), None, 0.0, 1.0, cv2.NORM_MINMAX)
-            img_mask = np.multiply(img, mask[:,:, np.newaxis])
-            img_mask = np.uint8(img_mask * 255)
-            output_unit.append(img_mask)
-            output_unit.append(np.uint8(np.ones((segment_size[0],margin,3))*255))
-        montage_unit = np.concatenate(output_unit, axis=1)
-        cv2.imwrite(os.path.join(output_folder, 'image', '%s-unit%03d.jpg'%(layer, unitID)), montage_unit)
-        if flag_crop == 1:
-            # load the library to crop image
-            import tightcrop
-            montage_unit_crop = tightcrop.crop_tiled_image(montage_unit, margin)
-            cv2.imwrite(os.path.join(output_folder, 'image', '%s-unit%03d_crop.jpg'%(layer, unitID)), montage_unit_crop)
+        shuffle=False,
+        pin_memory=device.type == 'cuda',
+        worker_init_fn=engine.pin_workers(worker_cores))
+    def capture_top():
+        # the maps are fanned out to the units on the device, nothing to copy back per batch
+        for rescore, feat in zip(rescores, features_capture.pop()):
+            rescore.update(feat)
+        return []
+    def report_top(info, features):
+        print('%d / %d' % (info+1, len(loader_top)))
+    executor.run(((input, batch_idx) for batch_idx, (input, paths) in enumerate(loader_top)), capture_top, report_top)
+
+    for layer, indices, rescore in zip(features_names, indices_layers, rescores):
+        maps = rescore.maps.cpu().numpy()
+        render_pool.submit_layer(output_folder, layer, maps,
+                                 [[imglist_results[item] for item in indices_unit] for indices_unit in indices],
+                                 rf_bank=rf_bank(layer, maps, indices, imglist_results))
+render_pool.close()
+print('%d units rendered' % render_pool.num_done)
+if thumbnails is not None:
+    thumbnails.save()
+    thumbnails.report()
+if cache is not None:
+    cache.save()
+    cache.report()
 print('done check results in ' + output_folder)
@@ -0,0 +1,135 @@
+# segmentation with the synthetic receptive field of the units
+# the python version of unit_segmentation/generateRF.m (maskRound): every
+# position of an H x W feature map has a round receptive field, a disk of
+# the RF size centered on the grid position in the image. The masks of all
+# the positions are one sparse matrix [H*W, h*w], built once per (layer,
+# feature map size, image size, RF size) and kept on disk, then a batch of
+# feature maps is segmented with a single sparse product: the positions
+# above threshold * the max of their map select the masks, and the image
+# pixels covered by any of them are the segmentation, as in
+# unit_segmentation/demo_unitsegments.m.
+#   python rfsegment.py   segments the images of unit_segmentation/data
+
+import os
+import numpy as np
+import scipy.sparse
+
+
+def disk_filter(radius):
+    """The normalized disk averaging filter of MATLAB fspecial('disk', radius).
+
+    The weight of a pixel is the part of its area inside the disk.
+    """
+    crad = int(np.ceil(radius - 0.5))
+    x, y = np.meshgrid(np.arange(-crad, crad + 1), np.arange(-crad, crad + 1))
+    maxxy = np.maximum(np.abs(x), np.abs(y)).astype(np.float64)
+    minxy = np.minimum(np.abs(x), np.abs(y)).astype(np.float64)
+    rad2 = radius ** 2
+    # the square roots are only used where they are real
+    m1 = np.where(rad2 < (maxxy + 0.5)**2 + (minxy - 0.5)**2, minxy - 0.5,
+                  np.sqrt(np.maximum(rad2 - (maxxy + 0.5)**2, 0)))
+    m2 = np.where(rad2 > (maxxy - 0.5)**2 + (minxy + 0.5)**2, minxy + 0.5,
+                  np.sqrt(np.maximum(rad2 - (maxxy - 0.5)**2, 0)))
+    a1 = np.arcsin(np.clip(m1 / radius, -1, 1))
+    a2 = np.arcsin(np.clip(m2 / radius, -1, 1))
+    partial = ((rad2 < (maxxy + 0.5)**2 + (minxy + 0.5)**2) & (rad2 > (maxxy - 0.5)**2 + (minxy - 0.5)**2)) | \
+              ((minxy == 0) & (maxxy - 0.5 < radius) & (maxxy + 0.5 >= radius))
+    sgrid = (rad2 * (0.5 * (a2 - a1) + 0.25 * (np.sin(2 * a2) - np.sin(2 * a1)))
+             - (maxxy - 0.5) * (m2 - m1) + (m1 - minxy + 0.5)) * partial
+    sgrid += (maxxy + 0.5)**2 + (minxy + 0.5)**2 < rad2
+    sgrid[crad, crad] = min(np.pi * rad2, np.pi / 2)
+    if crad > 0 and radius > crad - 0.5 and rad2 < (crad - 0.5)**2 + 0.25:
+        m1 = np.sqrt(rad2 - (crad - 0.5)**2)
+        m1n = m1 / radius
+        sg0 = 2 * (rad2 * (0.5 * np.arcsin(m1n) + 0.25 * np.sin(2 * np.arcsin(m1n))) - m1 * (crad - 0.5))
+        for row, col in [(2 * crad, crad), (crad, 2 * crad), (crad, 0), (0, crad)]:
+            sgrid[row, col] = sg0
+        for row, col in [(2 * crad - 1, crad), (crad, 2 * crad - 1), (crad, 1), (1, crad)]:
+            sgrid[row, col] -= sg0
+    sgrid[crad, crad] = min(sgrid[crad, crad], 1)
+    return sgrid / sgrid.sum()
+
+
+def mask_bank(grid_size, image_size, rf_size):
+    """Sparse float32 [H*W, h*w] receptive field masks of the positions of an H x W feature map.
+
+    grid_size is (H, W), image_size (h, w) and rf_size the diameter of the
+    receptive field in image pixels. Row r*W + c is the mask of position
+    (r, c), 1 inside the disk and the small weights of its rim as in
+    generateRF.m, on the grid of step floor(h / (H - 1)) from the top left.
+    """
+    grid_h, grid_w = grid_size
+    height, width = image_size
+    # the imfilter of a point of value 100 by the disk is the disk itself
+    # round half away from zero as MATLAB, round(65 / 2) is 33
+    kernel = 100 * disk_filter(int(np.floor(rf_size / 2.0 + 0.5)))
+    kernel = np.where(kernel > 0.01, 1, kernel).astype(np.float32)
+    ky, kx = np.nonzero(kernel)
+    values = kernel[ky, kx]
+    ky = ky - kernel.shape[0] // 2
+    kx = kx - kernel.shape[1] // 2
+    step_y = height // max(grid_h - 1, 1)
+    step_x = width // max(grid_w - 1, 1)
+
+    rows, cols, data = [], [], []
+    for r in range(grid_h):
+        for c in range(grid_w):
+            y = ky + r * step_y
+            x = kx + c * step_x
+            inside = (y >= 0) & (y < height) & (x >= 0) & (x < width)
+            rows.append(np.full(inside.sum(), r * grid_w + c))
+            cols.append(y[inside] * width + x[inside])
+            data.append(values[inside])
+    return scipy.sparse.csr_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(grid_h * grid_w, height * width), dtype=np.float32)
+
+
+def mask_bank_file(root, layer, grid_size, image_size, rf_size):
+    """Filename of the mask bank of a layer in root, built on the first call."""
+    if not os.path.exists(root):
+        os.makedirs(root)
+    filename = os.path.join(root, 'rf_%s_%dx%d_%dx%d_rf%d.npz' % (
+        layer, grid_size[0], grid_size[1], image_size[0], image_size[1], int(round(rf_size))))
+    if not os.path.exists(filename):
+        # written under a temporary name, a half written bank is never loaded
+        scipy.sparse.save_npz(filename + '.tmp.npz', mask_bank(grid_size, image_size, rf_size))
+        os.replace(filename + '.tmp.npz', filename)
+    return filename
+
+
+def load_mask_bank(filename):
+    return scipy.sparse.load_npz(filename).tocsr()
+
+
+def segment(maps, bank, image_size, threshold=0.5):
+    """Binary segmentations [n, h, w] of the images of the feature maps [n, H, W].
+
+    The positions of a map above threshold * its max select their masks in
+    bank, the union of the selected masks is the segmentation.
+    """
+    maps = np.asarray(maps, dtype=np.float32)
+    flat = maps.reshape(len(maps), -1)
+    selected = (flat > threshold * flat.max(1, keepdims=True)).astype(np.float32)
+    covered = (scipy.sparse.csr_matrix(selected) @ bank).toarray()
+    return (covered > 0).reshape((len(maps),) + tuple(image_size))
+
+
+if __name__ == '__main__':
+    # the python version of unit_segmentation/demo_unitsegments.m, conv5 unit 49 of Places-CNN (AlexNet)
+    import scipy.io
+    import cv2
+    rf_size = 65                # the average actual size of conv5
+    image_size = (227, 227)     # the input image size
+    unitID = 49
+    root = os.path.join('unit_segmentation', 'data')
+    images = [cv2.resize(cv2.imread(os.path.join(root, 'unitID%d_img%d.jpg' % (unitID, i))), image_size[::-1])
+              for i in range(1, 6)]
+    maps = [scipy.io.loadmat(os.path.join(root, 'unitID%d_feature%d.mat' % (unitID, i)))['featureMap']
+            for i in range(1, 6)]
+    bank = load_mask_bank(mask_bank_file('cache_rf', 'conv5', maps[0].shape, image_size, rf_size))
+    masks = segment(np.stack(maps), bank, image_size, 0.5)
+    # the segmented region at full intensity, the rest dimmed
+    weights = np.where(masks, 1.0, 0.2)[:, :, :, np.newaxis]
+    output = np.concatenate([np.uint8(image * weight) for image, weight in zip(images, weights)], 1)
+    cv2.imwrite('demo_unitsegments.jpg', output)
+    print('segmentations of unit %d in demo_unitsegments.jpg' % unitID)
@@ -0,0 +1,54 @@
+# tests of the feature capture of engine.py, run with python -m pytest
+
+import torch
+
+import engine
+
+
+def _model():
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 8, 3), torch.nn.BatchNorm2d(8), torch.nn.ReLU(inplace=True),
+                                torch.nn.Conv2d(8, 4, 3))
+    model[1].running_mean.normal_()
+    return model.eval()
+
+
+def test_capture_before_inplace_relu():
+    # the output of the batchnorm is overwritten by the in-place ReLU after it
+    model = _model()
+    input = torch.randn(2, 3, 16, 16)
+    with torch.no_grad():
+        expected = model[1](model[0](input))
+    capture = engine.FeatureCapture(model, ['1'])
+    engine.forward(model, input, torch.device('cpu'), channels_last=False)
+    feat = capture.pop()[0]
+    assert expected.min() < 0
+    assert torch.allclose(feat, expected)
+
+
+def test_capture_reduction_before_inplace_relu():
+    model = _model()
+    input = torch.randn(2, 3, 16, 16)
+    with torch.no_grad():
+        expected = model[1](model[0](input)).flatten(2).min(2)[0]
+    capture = engine.FeatureCapture(model, ['1'], {'1': 'topk:196'})
+    engine.forward(model, input, torch.device('cpu'), channels_last=True)
+    feat = capture.pop()[0]
+    assert torch.allclose(feat[:, :, -1], expected)
+
+
+def test_capture_cast_to_storage_dtype():
+    # the hook casts on the device to what featurestore.encode() gives on the host
+    from featurestore import encode, decode
+    model = _model()
+    input = torch.randn(2, 3, 16, 16)
+    with torch.no_grad():
+        expected = model[1](model[0](input)).flatten(2).max(2)[0].numpy()
+    for dtype in ['float16', 'bfloat16']:
+        capture = engine.FeatureCapture(model, ['1'], {'1': 'max'}, {'1': dtype})
+        engine.forward(model, input, torch.device('cpu'), channels_last=False)
+        feat = encode(capture.pop()[0].numpy(), dtype)
+        capture.remove()
+        assert feat.dtype == encode(expected, dtype).dtype
+        assert (feat == encode(expected, dtype)).all()
+        assert (decode(feat, dtype) == decode(encode(expected, dtype), dtype)).all()
@@ -0,0 +1,203 @@
+# cache of the decoded images at the segment resolution
+# the montages need the top images of every unit resized to segment_size,
+# and popular images are in the top of dozens of units, of every layer.
+# ThumbnailCache keeps them as uint8 BGR thumbnails in one memory-mapped
+# file, keyed by path, modification time and file size, so an image is
+# decoded from its full resolution JPEG once for all the layers, thresholds
+# and crops, and for the following runs too.
+#
+# The cache holds at most capacity thumbnails: beyond it a new thumbnail
+# takes the slot of the least recently used one instead of growing the
+# file. The slots handed out by get_slots() are pinned for the rest of the
+# run, as the render workers can still read them, so they are never reused
+# before save(). save() drops the entries beyond capacity and truncates the
+# file to capacity slots.
+#
+# Every thumbnail is decoded by PIL as in dataset.Dataset, whether it comes
+# from the scan or from a cache miss, so the top images are the pixels the
+# feature maps were computed on (PIL does not apply the EXIF rotation that
+# cv2.imread does).
+
+import os
+import json
+import heapq
+import threading
+import numpy as np
+import cv2
+
+
+# the decoder of the thumbnails in the index, a cache of another decoder is started over
+decoder = 'pil'
+
+
+def make_thumbnail(img, segment_size):
+    # uint8 BGR thumbnail of a PIL image resized to segment_size (w, h)
+    return cv2.resize(np.ascontiguousarray(np.asarray(img.convert('RGB'))[:, :, ::-1]), tuple(segment_size))
+
+
+def load_thumbnail(path, segment_size):
+    from PIL import Image
+    return make_thumbnail(Image.open(path), segment_size)
+
+
+def image_key(path):
+    st = os.stat(path)
+    return '%s:%d:%d' % (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+def open_thumbnails(filename, num_slots, segment_size, mode='r'):
+    # the thumbnails [num_slots, h, w, 3] as a memory-mapped array
+    shape = (num_slots, segment_size[1], segment_size[0], 3)
+    return np.memmap(filename, dtype=np.uint8, mode=mode, shape=shape)
+
+
+class ThumbnailCache(object):
+
+    def __init__(self, root, segment_size, capacity=100000):
+        self.segment_size = tuple(segment_size)
+        self.capacity = capacity
+        if not os.path.exists(root):
+            os.makedirs(root)
+        name = 'thumbnails_%dx%d' % self.segment_size
+        self.filename = os.path.join(root, name + '.bin')
+        self.index_file = os.path.join(root, name + '.json')
+        self.entries = {}   # key -> [slot, last use]
+        self.num_slots = 0
+        if os.path.exists(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+            if index.get('decoder') == decoder:
+                self.entries = index['entries']
+                self.num_slots = index['num_slots']
+        self.clock = max([used for slot, used in self.entries.values()] + [0]) + 1
+        self._reset_slots()
+        self.thumbnails = None
+        self.pinned = set()     # slots which may be read by the render workers
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _reset_slots(self):
+        # free slots and the heap of (last use, key) of the entries
+        used_slots = set(slot for slot, used in self.entries.values())
+        self.free = [slot for slot in range(self.num_slots - 1, -1, -1) if slot not in used_slots]
+        self.lru = [(used, key) for key, (slot, used) in self.entries.items()]
+        heapq.heapify(self.lru)
+
+    def slot_bytes(self):
+        return self.segment_size[0] * self.segment_size[1] * 3
+
+    def _map(self):
+        # map the file on the first access, whether or not it is to store a thumbnail
+        if self.thumbnails is None and self.num_slots > 0:
+            self.thumbnails = open_thumbnails(self.filename, self.num_slots, self.segment_size, 'r+')
+
+    def _grow(self, num_slots):
+        # extend the file and map it again, up to capacity unless the pinned slots need more
+        if self.thumbnails is not None:
+            self.thumbnails.flush()
+        if self.num_slots < self.capacity:
+            num_slots = max(num_slots, min(max(2 * self.num_slots, 1024), self.capacity))
+        else:
+            num_slots = max(num_slots, self.num_slots + 256)
+        with open(self.filename, 'ab') as f:
+            f.truncate(num_slots * self.slot_bytes())
+        self.free = list(range(num_slots - 1, self.num_slots - 1, -1)) + self.free
+        self.num_slots = num_slots
+        self.thumbnails = open_thumbnails(self.filename, num_slots, self.segment_size, 'r+')
+
+    def _evict(self):
+        # give the slot of the least recently used entry which is not pinned back, False if there is none
+        while self.lru:
+            used, key = heapq.heappop(self.lru)
+            entry = self.entries.get(key)
+            # an older use of an entry used again since, or a pinned one, back in the heap at save()
+            if entry is None or entry[1] != used or entry[0] in self.pinned:
+                continue
+            self.free.append(self.entries.pop(key)[0])
+            return True
+        return False
+
+    def _touch(self, key, slot):
+        self.entries[key] = [slot, self.clock]
+        heapq.heappush(self.lru, (self.clock, key))
+        self.clock += 1
+
+    def _slot(self, key):
+        self._map()
+        if key in self.entries:
+            slot = self.entries[key][0]
+            self._touch(key, slot)
+            return slot, True
+        if not self.free:
+            if self.num_slots < self.capacity or not self._evict():
+                self._grow(self.num_slots + 1)
+        slot = self.free.pop()
+        self._touch(key, slot)
+        return slot, False
+
+    def put(self, path, thumbnail):
+        # store a thumbnail decoded elsewhere, e.g. by the DataLoader workers of the scan
+        with self.lock:
+            slot, found = self._slot(image_key(path))
+            if not found:
+                self.thumbnails[slot] = thumbnail
+            return slot
+
+    def get_slots(self, paths):
+        """Slots of the thumbnails of paths, the missing ones are decoded and stored."""
+        slots = []
+        with self.lock:
+            for path in paths:
+                slot, found = self._slot(image_key(path))
+                if found:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+                    self.thumbnails[slot] = load_thumbnail(path, self.segment_size)
+                self.pinned.add(slot)
+                slots.append(slot)
+        return slots
+
+    def read(self, slots):
+        # uint8 [n, h, w, 3] batch of the thumbnails in slots of get_slots()
+        with self.lock:
+            self._map()
+            return np.array(self.thumbnails[slots])
+
+    def flush(self):
+        # readers in other processes see everything stored so far
+        if self.thumbnails is not None:
+            self.thumbnails.flush()
+
+    def save(self):
+        # call it once nothing reads the cache any more, the file may be truncated
+        with self.lock:
+            if len(self.entries) > self.capacity:
+                # drop the least recently used entries, their slots are reused next time
+                order = sorted(self.entries.items(), key=lambda item: item[1][1], reverse=True)
+                self.entries = dict(order[:self.capacity])
+            if self.num_slots > self.capacity:
+                # move the entries beyond capacity to the free slots before it and truncate the file
+                self._map()
+                used_slots = set(slot for slot, used in self.entries.values())
+                free = [slot for slot in range(self.capacity - 1, -1, -1) if slot not in used_slots]
+                for entry in self.entries.values():
+                    if entry[0] >= self.capacity:
+                        slot = free.pop()
+                        self.thumbnails[slot] = self.thumbnails[entry[0]]
+                        entry[0] = slot
+                self.thumbnails.flush()
+                self.thumbnails = None
+                with open(self.filename, 'r+b') as f:
+                    f.truncate(self.capacity * self.slot_bytes())
+                self.num_slots = self.capacity
+            self.pinned = set()
+            self._reset_slots()
+            self.flush()
+            with open(self.index_file + '.tmp', 'w') as f:
+                json.dump({'entries': self.entries, 'num_slots': self.num_slots, 'decoder': decoder}, f)
+            os.replace(self.index_file + '.tmp', self.index_file)
+
+    def report(self):
+        print('thumbnail cache: %d hits, %d misses, %d entries' % (self.hits, self.misses, len(self.entries)))
@@ -8,17 +8,18 @@
 
 import os
 import sys
+import json
+import time
+import multiprocessing
 import numpy
 import random
 
 import numpy as np
 import scipy.ndimage as ndimage
-import scipy.spatial as spatial
-import scipy.misc as misc
-import matplotlib.pyplot as plt
-import matplotlib.patches as patches
 
 import cv2
+# scipy.spatial and matplotlib are imported where they are used, cropping
+# the montages does not need matplotlib at all
 class BBox(object):
     def __init__(self, x1, y1, x2, y2):
         '''
@@ -50,6 +51,8 @@ class BBox(object):
                 and self.y1 == other.y1
                 and self.x2 == other.x2
                 and self.y2 == other.y2)
+    # the boxes are mutated while they are merged, python 3 needs the hash spelled out
+    __hash__ = object.__hash__
 
 def find_paws(data, smooth_radius = 5, threshold = 0.0001):
     # http://stackoverflow.com/questions/4087919/how-can-i-improve-my-paw-detection
@@ -97,6 +100,7 @@ def remove_overlaps(bboxes):
         corners.append(lr)
 
     # Use a KDTree so we can find corners that are nearby efficiently.
+    import scipy.spatial as spatial
     tree = spatial.KDTree(corners)
     new_corners = []
     for corner in ulcorners:
@@ -117,6 +121,9 @@ def remove_overlaps(bboxes):
     return set(bbox_map.values())
 
 if False:
+    import scipy.misc as misc
+    import matplotlib.pyplot as plt
+    import matplotlib.patches as patches
     fig = plt.figure()
     ax = fig.add_subplot(111)
 
@@ -138,15 +145,19 @@ if False:
 
 
 
+# the montages of the units of a series of training snapshots, the templates
+# get the root, the basename and iteration of the snapshot and the unit
+#root_snapshots = '/data/vision/torralba/gigaSUN/www/unit_annotation/result_segments_iterations'
+root_snapshots = '/data/vision/torralba/scratch2/davidbau/iccv'
+input_template = '{root}/{basename}_iter_{iteration}/html/image/conv5-{unit:04d}.jpg'
+output_template = '{root}/{basename}_iter_{iteration}/html/image/conv5-{unit:04d}_crop.jpg'
+num_units_snapshot = 256
+
 def input_image_filename(basename, iter, zunit):
-#    return ('/data/vision/torralba/gigaSUN/www/unit_annotation/result_segments_iterations' +
-    return ('/data/vision/torralba/scratch2/davidbau/iccv' +
-        '/%s_iter_%d/html/image/conv5-%04d.jpg' % (basename, iter, zunit))
+    return input_template.format(root=root_snapshots, basename=basename, iteration=iter, unit=zunit)
 
 def output_image_filename(basename, iter, zunit):
-#    return ('/data/vision/torralba/gigaSUN/www/unit_annotation/result_segments_iterations' +
-    return ('/data/vision/torralba/scratch2/davidbau/iccv' +
-        '/%s_iter_%d/html/image/conv5-%04d_crop.jpg' % (basename, iter, zunit))
+    return output_template.format(root=root_snapshots, basename=basename, iteration=iter, unit=zunit)
 
 def biggest_square_bbox(data, smooth_radius, threshold):
     data_slices = find_paws(data, smooth_radius=smooth_radius, threshold=threshold)
@@ -185,8 +196,79 @@ def crop_tiled_image(data, border=3):
         outdata[:,x:x+width,:] = best_tightcrop(onesquare)
     return outdata
 
+# batch crop of the snapshot series
+# crop_snapshots() hands the (input, output) pairs of all the snapshots to a
+# pool of processes, one per core. The outputs which are done are recorded in
+# a manifest, so a rerun skips them without a stat call per file, and an
+# input which is not there yet, or not completely written, is simply tried
+# again by the next run.
+
+def _init_crop_worker():
+    # one process per core, no nested thread pools
+    cv2.setNumThreads(1)
+
+def _crop_job(job):
+    input_image, output_image = job
+    try:
+        buffer = np.fromfile(input_image, dtype=np.uint8)
+    except (IOError, OSError):
+        # not rendered yet
+        return output_image, False
+    # an empty or half written montage is still being rendered, it is tried again by the next run
+    data = cv2.imdecode(buffer, cv2.IMREAD_COLOR) if len(buffer) else None
+    if data is None:
+        return output_image, False
+    cv2.imwrite(output_image, crop_tiled_image(data))
+    return output_image, True
+
+def _save_manifest(manifest_file, done):
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump({'done': sorted(done)}, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def crop_snapshots(snapshots, num_units=None, num_workers=None, manifest_file='tightcrop_manifest.json',
+                   checkpoint_every=1000):
+    """Crop the montages of the units of the (basename, iteration) snapshots in num_workers processes.
+
+    Remove the manifest to crop everything again.
+    """
+    num_units = num_units or num_units_snapshot
+    done = set()
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            done = set(json.load(f)['done'])
+    jobs = [(input_image_filename(basename, iteration, zunit), output_image_filename(basename, iteration, zunit))
+            for basename, iteration in snapshots for zunit in range(num_units)]
+    num_skipped = len(jobs)
+    jobs = [job for job in jobs if job[1] not in done]
+    num_skipped -= len(jobs)
+
+    start = time.time()
+    num_cropped = 0
+    num_missing = 0
+    pool = multiprocessing.Pool(num_workers or os.cpu_count(), initializer=_init_crop_worker)
+    try:
+        for output_image, cropped in pool.imap_unordered(_crop_job, jobs, chunksize=8):
+            if not cropped:
+                num_missing += 1
+                continue
+            done.add(output_image)
+            num_cropped += 1
+            if num_cropped % checkpoint_every == 0:
+                _save_manifest(manifest_file, done)
+                print('%d / %d cropped, %.1f montages/sec' % (num_cropped, len(jobs), num_cropped / (time.time() - start)))
+    finally:
+        pool.close()
+        pool.join()
+        _save_manifest(manifest_file, done)
+    print('%d montages cropped in %.1fs (%.1f/sec), %d already done, %d inputs missing' % (
+        num_cropped, time.time() - start, num_cropped / max(time.time() - start, 1e-9), num_skipped, num_missing))
+
 def process_iteration(basename, iteration, show_things=False):
-    for zunit in range(256):
+    if not show_things:
+        crop_snapshots([(basename, iteration)])
+        return
+    for zunit in range(num_units_snapshot):
         input_image = input_image_filename(basename, iteration, zunit)
         output_image = output_image_filename(basename, iteration, zunit)
         if os.path.exists(output_image)==False and os.path.exists(input_image)==True:
@@ -194,17 +276,18 @@ def process_iteration(basename, iteration, show_things=False):
             data = cv2.imread(input_image)
             cropped = crop_tiled_image(data)
             cv2.imwrite(output_image, cropped)
-            if show_things:
-                plt.imshow(data)
-                plt.show()
-                plt.imshow(crop_tiled_image(data))
-                plt.show()
+            import matplotlib.pyplot as plt
+            plt.imshow(data)
+            plt.show()
+            plt.imshow(crop_tiled_image(data))
+            plt.show()
 
 
 def process_snapshot():
     name = '/data/vision/oliva/scenedataset/modelzoo/list_iterations.txt'
     with open(name) as f:
         lines = f.readlines()
+    snapshots = []
     for line in lines:
         print(line)
         model_name = line.rstrip()
@@ -216,12 +299,82 @@ def process_snapshot():
         basename = '_'.join(items[:-2])
         iteration = int(items[-1])
         print(basename, iteration)
-        process_iteration(basename, iteration)
+        snapshots.append((basename, iteration))
+    # all the snapshots go to the same pool
+    crop_snapshots(snapshots)
 
 def process_snapshot_iterations():
     basename = 'places'
     iters = [1,2,4,9,20,44,99,223,492,1108,2446,5509,12164,27396,60491,136238,300818,600818,1200818,2400818]
-    for iteration in iters:
-        process_iteration(basename, iteration)
-
-
+    crop_snapshots([(basename, iteration) for iteration in iters])
+
+
+# tight crop from the segmentation masks
+# the montages of pytorch_generate_unitsegments.py are rendered from binary
+# masks which are still in memory, so the regions need not be detected again
+# from the pixels of the montage. mask_boxes() labels the connected regions
+# of the masks of all the tiles in one ndimage.label call (the tiles are not
+# connected to each other), merges the overlapping boxes of every tile and
+# makes the biggest one square, crop_tiles() zooms every tile into its box.
+
+def _merge_overlaps(boxes):
+    # boxes [(x1, y1, x2, y2)], ends exclusive, merged until none of them overlap
+    boxes = list(boxes)
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]:
+                    boxes[i] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
+
+def mask_boxes(masks, min_size=10):
+    """Square crop box (x1, y1, x2, y2) of each of the masks [n, h, w], ends exclusive.
+
+    The box is around the biggest region of the mask once the overlapping
+    regions are merged. A row is -1 when the tile is better kept as it is:
+    an empty mask or a box smaller than min_size.
+    """
+    num_tiles, height, width = masks.shape
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[1] = ndimage.generate_binary_structure(2, 1)
+    labels, num_labels = ndimage.label(masks > 0, structure)
+    regions = [[] for i in range(num_tiles)]
+    for region in ndimage.find_objects(labels):
+        tile, rows, cols = region
+        regions[tile.start].append((cols.start, rows.start, cols.stop, rows.stop))
+
+    boxes = np.full((num_tiles, 4), -1, dtype=np.int64)
+    for i, regions_tile in enumerate(regions):
+        if not regions_tile:
+            continue
+        x1, y1, x2, y2 = max(_merge_overlaps(regions_tile), key=lambda b: (b[2] - b[0]) * (b[3] - b[1]))
+        # grow the short side around its center, the box stays in the tile
+        side = min(max(x2 - x1, y2 - y1), width, height)
+        if side < min_size:
+            continue
+        x1 = min(width - side, max(0, (x1 + x2 - side) // 2))
+        y1 = min(height - side, max(0, (y1 + y2 - side) // 2))
+        boxes[i] = (x1, y1, x1 + side, y1 + side)
+    return boxes
+
+
+def crop_tiles(montage, boxes, border=3):
+    """Copy of the montage [h, n * (w + border), 3] with tile i zoomed into boxes[i]."""
+    outdata = montage.copy()
+    height = montage.shape[0]
+    width = (montage.shape[1] // len(boxes)) - border if len(boxes) else 0
+    for i, (x1, y1, x2, y2) in enumerate(boxes):
+        if x1 < 0:
+            continue
+        x0 = i * (width + border)
+        outdata[:, x0:x0 + width] = cv2.resize(montage[y1:y2, x0 + x1:x0 + x2], (width, height))
+    return outdata
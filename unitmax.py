@@ -0,0 +1,99 @@
+# the max activation of every unit on every image, shared with MATLAB
+# unitMax_<network>.h5 has one dataset per layer with the N x units max over
+# space (float32) of the N images of the image list, and as attributes of
+# the root group the model, the digest of its weights, the preprocessing of
+# the images and the SHA-1 of the image list. The file is only reused when
+# all four are the same, so a run with another model, other weights, input
+# size or image list extracts again. The weights digest is
+# actcache.model_digest() on the Python side and the SHA-1 of the
+# .caffemodel file on the MATLAB side.
+#
+# It is a plain HDF5 file, in MATLAB
+#   layers_unitMax{i} = h5read('unitMax_<network>.h5', ['/' layers{i}]);
+# gives the N x units matrix, see generate_unitsegments.m. MATLAB is column
+# major, so the datasets are stored as units x N on the Python side.
+# h5py is only needed to write or read the file.
+
+import os
+import hashlib
+import numpy as np
+
+
+def imagelist_hash(imglist):
+    # SHA-1 of the image paths joined by newlines, the same in generate_unitsegments.m
+    return hashlib.sha1('\n'.join(imglist).encode('utf-8')).hexdigest()
+
+
+def _attr_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    if isinstance(value, np.ndarray):
+        return _attr_str(value.ravel()[0])
+    return str(value)
+
+
+def save_unitmax(filename, features_names, maxfeatures, imglist, model, weights_digest, preprocessing):
+    """Write the [N, units] float32 max activations of every layer with their metadata."""
+    try:
+        import h5py
+    except ImportError:
+        print('h5py is not installed, the max activations are not saved to %s' % filename)
+        return
+    with h5py.File(filename + '.tmp', 'w') as f:
+        for name, feat in zip(features_names, maxfeatures):
+            f.create_dataset(name, data=np.ascontiguousarray(np.asarray(feat, dtype=np.float32).T))
+        # fixed length strings, h5readatt reads them as char arrays
+        f.attrs['model'] = np.bytes_(model)
+        f.attrs['weights_digest'] = np.bytes_(weights_digest)
+        f.attrs['preprocessing'] = np.bytes_(preprocessing)
+        f.attrs['imagelist_sha1'] = np.bytes_(imagelist_hash(imglist))
+        f.attrs['num_images'] = len(imglist)
+    # only a complete file has the final name
+    os.replace(filename + '.tmp', filename)
+
+
+def load_unitmax(filename, features_names, imglist, model, weights_digest, preprocessing):
+    """The [N, units] float32 max activations of features_names, None if the file is not valid.
+
+    The file is valid for the same image list, model, weights and preprocessing.
+    """
+    if not os.path.exists(filename):
+        return None
+    try:
+        import h5py
+    except ImportError:
+        print('h5py is not installed, %s is not used' % filename)
+        return None
+    with h5py.File(filename, 'r') as f:
+        if not _valid(f, filename, features_names, imglist, model, weights_digest, preprocessing):
+            return None
+        return [f[name][()].T for name in features_names]
+
+
+def remove_stale_unitmax(filename, features_names, imglist, model, weights_digest, preprocessing):
+    # remove the file if it is not valid any more, generate_unitsegments.m would still read it
+    if not os.path.exists(filename):
+        return
+    try:
+        import h5py
+    except ImportError:
+        return
+    with h5py.File(filename, 'r') as f:
+        valid = _valid(f, filename, features_names, imglist, model, weights_digest, preprocessing)
+    if not valid:
+        print('%s is out of date, removed' % filename)
+        os.remove(filename)
+
+
+def _valid(f, filename, features_names, imglist, model, weights_digest, preprocessing):
+    expected = {'imagelist_sha1': imagelist_hash(imglist), 'model': model, 'weights_digest': weights_digest,
+                'preprocessing': preprocessing}
+    for key, value in expected.items():
+        if _attr_str(f.attrs.get(key, '')) != value:
+            print('%s is for another %s' % (filename, key))
+            return False
+    missing = [name for name in features_names if name not in f]
+    if missing:
+        print('%s has no layer %s' % (filename, ', '.join(missing)))
+        return False
+    return True
@@ -0,0 +1,180 @@
+# streaming top-k images of every unit
+# UnitTopK goes along with the scan of the dataset: for each batch of
+# feature maps it merges the batch with the current top-k of every unit
+# using torch.topk, and keeps the scores (max over space), the image ids and
+# the feature maps of the winners. After one pass over the images the
+# montages can be rendered from the kept maps, there is no need to forward
+# the top images of every unit a second time.
+# When a second pass is needed anyway (e.g. after --merge of the shards),
+# RescoreTopK forwards each of the top images once, however many units
+# rank it, instead of once per unit.
+# save_topk() keeps the top-k of every layer on disk with the image list
+# their ids refer to, so when images are added to the probe set a later run
+# only forwards the new ones on top of load_topk(). The saved top-k is only
+# used with the same model weights and preprocessing.
+
+import os
+import json
+import numpy as np
+import torch
+
+from featurestore import decode
+
+
+class UnitTopK(object):
+
+    def __init__(self, k, offset=0):
+        self.k = k
+        self.num_seen = offset  # id of the next image, offset for a slice of the image list
+        self.scores = None      # [units, k] max over space, sorted largest first
+        self.indices = None     # [units, k] id of the image in the image list
+        self.maps = None        # [units, k, H, W] feature maps
+
+    def load(self, scores, indices, maps, device=None):
+        # go on from a saved top-k, the ids of the new images start at offset
+        self.scores = torch.as_tensor(scores, device=device)
+        self.indices = torch.as_tensor(indices, device=device)
+        self.maps = torch.as_tensor(maps, device=device)
+
+    def update(self, feat, ids=None):
+        """Merge a batch of feature maps [B, units, H, W] and return their max [B, units].
+
+        The images are the next B ones of the list, or the ones with the given ids [B].
+        """
+        batch = feat.shape[0]
+        scores = feat.flatten(2).max(2)[0]
+        if ids is None:
+            indices = torch.arange(self.num_seen, self.num_seen + batch, device=feat.device)
+            self.num_seen += batch
+        else:
+            indices = torch.as_tensor(ids, device=feat.device)
+
+        scores_units = scores.t()
+        indices_units = indices.unsqueeze(0).expand_as(scores_units)
+        maps_units = feat.transpose(0, 1)
+        if self.scores is not None:
+            scores_units = torch.cat([self.scores, scores_units], 1)
+            indices_units = torch.cat([self.indices, indices_units], 1)
+            maps_units = torch.cat([self.maps, maps_units], 1)
+
+        top_scores, order = scores_units.topk(min(self.k, scores_units.shape[1]), dim=1)
+        self.scores = top_scores
+        self.indices = indices_units.gather(1, order)
+        units = torch.arange(order.shape[0], device=order.device).unsqueeze(1)
+        self.maps = maps_units[units, order]
+        return scores
+
+    def ranked(self, ids):
+        # bool [B], whether the images with ids [B] are in the top-k of any unit
+        ids = torch.as_tensor(ids, device=self.indices.device)
+        return (self.indices.reshape(-1, 1) == ids).any(0)
+
+    def numpy(self):
+        # (scores, indices, maps) on the host
+        return self.scores.cpu().numpy(), self.indices.cpu().numpy(), self.maps.cpu().numpy()
+
+
+def save_topk(root, names, trackers, imglist, model=None, preprocessing=None):
+    """Save the top-k of the layers names and the image list of their ids.
+
+    model (e.g. the digest of its weights) and preprocessing are kept to
+    check the saved state against in load_topk().
+    """
+    if not os.path.exists(root):
+        os.makedirs(root)
+    for name, tracker in zip(names, trackers):
+        scores, indices, maps = tracker.numpy()
+        arrays = {'scores': scores, 'indices': indices, 'maps': maps}
+        filename = os.path.join(root, '%s_topk.npz' % name)
+        with open(filename + '.tmp', 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(filename + '.tmp', filename)
+    # the meta goes last, the state is only loaded once it is complete
+    with open(os.path.join(root, 'imglist.txt'), 'w') as f:
+        f.write('\n'.join(imglist))
+    meta_file = os.path.join(root, 'meta.json')
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump({'features_names': list(names), 'k': trackers[0].k, 'num_images': len(imglist),
+                   'model': model, 'preprocessing': preprocessing}, f)
+    os.replace(meta_file + '.tmp', meta_file)
+
+
+def load_topk(root, names, k, model=None, preprocessing=None):
+    """(imglist, [(scores, indices, maps)] aligned with names) saved by save_topk.
+
+    None if there is nothing saved for the same layers, k, model and preprocessing.
+    """
+    meta_file = os.path.join(root, 'meta.json')
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta['features_names'] != list(names) or meta['k'] != k:
+        return None
+    for key, value in [('model', model), ('preprocessing', preprocessing)]:
+        if meta.get(key) != value:
+            print('the saved top-k in %s is for another %s' % (root, key))
+            return None
+    with open(os.path.join(root, 'imglist.txt')) as f:
+        imglist = f.read().splitlines()[:meta['num_images']]
+    states = []
+    for name in names:
+        arrays = np.load(os.path.join(root, '%s_topk.npz' % name))
+        states.append((arrays['scores'], arrays['indices'], arrays['maps']))
+    return imglist, states
+
+
+def changed_units(indices_before, indices_after):
+    # ids of the units whose top images are not the same any more
+    if indices_before.shape != indices_after.shape:
+        return np.arange(len(indices_after))
+    return np.nonzero((indices_before != indices_after).any(1))[0]
+
+
+def top_indices(scores, k, dtype='float32'):
+    """[units, k] ids of the top images of every unit from the [N, units] max activations."""
+    num_images, num_units = scores.shape
+    k = min(k, num_images)
+    indices = np.zeros((num_units, k), dtype=np.int64)
+    for unitID in range(num_units):
+        # one column at a time, scores can be a memory-mapped file in a storage dtype
+        activations_unit = decode(scores[:, unitID], dtype)
+        idx_top = np.argpartition(-activations_unit, k - 1)[:k]
+        indices[unitID] = idx_top[np.argsort(-activations_unit[idx_top], kind='stable')]
+    return indices
+
+
+class RescoreTopK(object):
+    """Feature maps of the known top images of every unit, each image forwarded once.
+
+    Scene images are in the top of many units, so the images to forward are
+    the unique ids in indices [units, k], in image_ids order. update() gets
+    their feature maps batch by batch and fans every map out to all the
+    units which rank the image. Several layers can share one pass over the
+    sorted union of their image_ids, see union_ids().
+    """
+
+    def __init__(self, indices, image_ids=None):
+        self.indices = indices
+        if image_ids is None:
+            image_ids = np.unique(indices)
+        self.image_ids = np.asarray(image_ids)
+        self.positions = torch.from_numpy(np.searchsorted(self.image_ids, indices))
+        self.num_seen = 0
+        self.maps = None    # [units, k, H, W]
+
+    def update(self, feat):
+        # feat [B, units, H, W] of the next B images of image_ids
+        batch = feat.shape[0]
+        positions = self.positions.to(feat.device)
+        if self.maps is None:
+            self.maps = feat.new_zeros(positions.shape + feat.shape[2:])
+        in_batch = (positions >= self.num_seen) & (positions < self.num_seen + batch)
+        units, ranks = in_batch.nonzero(as_tuple=True)
+        self.maps[units, ranks] = feat[positions[units, ranks] - self.num_seen, units]
+        self.num_seen += batch
+
+
+def union_ids(indices_layers):
+    # sorted ids of the images in the top of any unit of any layer
+    return np.unique(np.concatenate([indices.ravel() for indices in indices_layers]))